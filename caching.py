@@ -0,0 +1,182 @@
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+class PostingsCache:
+    """LRU cache of postings lists shared by the ingredient and the content searchers. Every entry is a pair of
+    numpy arrays (docids, tfs) and the cache is bounded by the bytes those arrays take, not by the number of
+    entries, so a few huge lists ("salt", "easy") cannot push out thousands of small ones unnoticed.
+    Keys are (index name, term). Safe to use from several threads."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_bytes(key, docids, tfs):
+        return docids.nbytes + tfs.nbytes + sys.getsizeof(key[1])
+
+    def get(self, key, loader):
+        """Postings stored under `key`. On a miss `loader()` is called (outside of the lock, concurrent misses
+        on the same key may both load) and must return (docids, tfs) arrays"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        docids, tfs = loader()
+        size = self._entry_bytes(key, docids, tfs)
+        if size > self.max_bytes:
+            return docids, tfs
+        # the cached arrays are shared between requests, nobody is allowed to modify them
+        docids.flags.writeable = False
+        tfs.flags.writeable = False
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (docids, tfs)
+                self.resident_bytes += size
+                while self.resident_bytes > self.max_bytes:
+                    old_key, (old_docids, old_tfs) = self._entries.popitem(last=False)
+                    self.resident_bytes -= self._entry_bytes(old_key, old_docids, old_tfs)
+                    self.evictions += 1
+        return docids, tfs
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+def postings_to_arrays(postings):
+    """Converts a pyserini postings list (or None for an unknown term) into (docids, tfs) int32 arrays"""
+    if postings is None:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    docids = np.fromiter((p.docid for p in postings), dtype=np.int32, count=len(postings))
+    tfs = np.fromiter((p.tf for p in postings), dtype=np.int32, count=len(postings))
+    return docids, tfs
+
+class ResultCache:
+    """LRU cache of finished results (encoded response bodies) with a time to live and a memory cap. Every entry
+    is stored with its size in bytes: the least recently used entries are evicted once there are more than
+    `max_entries` or they take more than `max_bytes`, and an entry older than `ttl` seconds is never returned.
+    With sliding=True the age of an entry counts from its last get() instead of its put(). Entries belong to an
+    index version (set_version), a new version drops everything cached before it.
+    Safe to use from several threads."""
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=600, version=None, sliding=False):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sliding = sliding
+        self.version = version
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.resident_bytes -= size
+
+    def get(self, key):
+        """The value cached under `key`, None on a miss"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[2] > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.sliding:
+                self._entries[key] = (entry[0], entry[1], now)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """Caches `value` (len(value) bytes unless `size` is given), values bigger than the whole cache are not kept"""
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self.resident_bytes += size
+            while len(self._entries) > self.max_entries or self.resident_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def set_version(self, version):
+        """Switches to another index version, everything cached for the previous one is dropped"""
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._entries.clear()
+                self.resident_bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'resident_bytes': self.resident_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'sliding': self.sliding,
+                'version': self.version,
+            }
+
+WHITESPACE = re.compile(r'\s+')
+
+def canonical_ingredients(ingredients_string):
+    """The ingredient list of a query in one canonical spelling: lowercased, single spaces, empty entries and
+    duplicates dropped, sorted. "Garlic, chicken ,garlic," -> "chicken, garlic". The searcher treats the
+    ingredients as a set, so searching the canonical form gives the result of every query that maps to it"""
+    ingredients = {WHITESPACE.sub(' ', ingredient).strip().lower() for ingredient in ingredients_string.split(',')}
+    return ', '.join(sorted(ingredient for ingredient in ingredients if ingredient))
+
+def canonical_keywords(keywords_string):
+    """Lowercased keywords with single spaces, the content analyzer lowercases and splits on whitespace anyway"""
+    return WHITESPACE.sub(' ', keywords_string).strip().lower()
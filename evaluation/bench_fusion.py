@@ -0,0 +1,83 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import bisect
+import math
+import time
+from collections import defaultdict
+
+import numpy as np
+import fusion
+
+# Compares fusion.fuse with the bisect loop CustomRecipeSearcher.search used before, on two synthetic
+# 10k-deep result lists (the depth search retrieves for k=1000) that share part of their documents
+NUM_DOCS = 500000
+DEPTH = 10000
+OVERLAP = 0.3
+K = 1000
+REPEATS = 5
+
+def make_lists(seed=0):
+    rng = np.random.default_rng(seed)
+    ingredient_docids = rng.choice(NUM_DOCS, DEPTH, replace=False)
+    shared = ingredient_docids[rng.choice(DEPTH, int(DEPTH * OVERLAP), replace=False)]
+    others = rng.choice(np.setdiff1d(np.arange(NUM_DOCS), ingredient_docids), DEPTH - len(shared), replace=False)
+    keyword_docids = rng.permutation(np.concatenate([shared, others]))
+    # bm25 like positive scores and query likelihood like negative ones, both sorted best first
+    ingredient_scores = np.sort(rng.gamma(2.0, 3.0, DEPTH))[::-1]
+    keyword_scores = np.sort(-rng.gamma(5.0, 4.0, DEPTH))[::-1]
+    return (ingredient_docids, ingredient_scores), (keyword_docids, keyword_scores)
+
+def legacy_fuse(ingredient_results, keyword_results, k, ranking):
+    """The fusion loop of CustomRecipeSearcher before the fusion module, lists of (url, score) tuples"""
+    def sigmoid(x):
+        return 1 / (1 + math.exp(-x))
+    def convert_scores(scores):
+        res = defaultdict(lambda :{'score': 0, 'rank': 1})
+        for i in range(len(scores)):
+            res[scores[i][0]] = {'score': sigmoid(scores[i][1]), 'rank': i + 1}
+        return res
+    ingredient_results = convert_scores(ingredient_results)
+    keyword_results = convert_scores(keyword_results)
+    top_k = []
+    for key in set(list(ingredient_results.keys()) + list(keyword_results.keys())):
+        if ranking == 'simple':
+            score = ingredient_results[key]['score'] + keyword_results[key]['score']
+        else:
+            score = (ingredient_results[key]['score'] / ingredient_results[key]['rank']
+                     + keyword_results[key]['score'] / keyword_results[key]['rank'])
+        bisect.insort(top_k, (key, score), key=lambda x:x[1])
+        if len(top_k) > k:
+            top_k.pop(0)
+    top_k.reverse()
+    return top_k[:k]
+
+def best_of(fn, repeats=REPEATS):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == "__main__":
+    ingredient_ranked, keyword_ranked = make_lists()
+    urls = [f"https://www.food.com/recipe/{i}" for i in range(NUM_DOCS)]
+    as_tuples = lambda ranked: [(urls[d], float(s)) for d, s in zip(ranked[0].tolist(), ranked[1])]
+    ingredient_results, keyword_results = as_tuples(ingredient_ranked), as_tuples(keyword_ranked)
+
+    print(f"{DEPTH} + {DEPTH} results, {int(OVERLAP * 100)}% overlap, k={K}")
+    for ranking in ['simple', 'rank_scaled']:
+        legacy_time, legacy = best_of(lambda: legacy_fuse(ingredient_results, keyword_results, K, ranking))
+        # the fused ids are turned back into urls so both return the same thing
+        fused_time, fused = best_of(lambda: as_tuples(fusion.fuse([ingredient_ranked, keyword_ranked], K, ranking)))
+        same = np.allclose([s for _, s in legacy], [s for _, s in fused], rtol=1e-9)
+        print(f"{ranking:>15}: legacy {legacy_time * 1000:8.2f} ms   fusion {fused_time * 1000:7.2f} ms   "
+              f"x{legacy_time / fused_time:5.1f}   same scores: {same}")
+    for ranking in ['reciprocal_rank', 'combsum', 'combmnz']:
+        fused_time, _ = best_of(lambda: fusion.fuse([ingredient_ranked, keyword_ranked], K, ranking))
+        print(f"{ranking:>15}: fusion {fused_time * 1000:7.2f} ms")
@@ -0,0 +1,72 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import json
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from recipe_store import RecipeStore
+from retrieval import RecipeInfoRetrieval
+
+# Time to hydrate a result list of k recipe ids: the shelf as _filter_and_return used it (RecipeInfoRetrieval,
+# opened and closed around every request, one get per recipe) against RecipeStore.get_many.
+# Run scripts/migrate_recipe_store.py first
+
+# Path FROM THE ROOT OF THE PROJECT
+RECIPE_SHELVES_PATH = 'files/foodrecipes_shelves/foodrecipes_shelves.db'
+RECIPE_STORE_PATH = 'files/foodrecipes_store/foodrecipes.sqlite'
+KS = [10, 100, 1000]
+REQUESTS = 20
+# concurrent requests for the second run, the shelf serialises them
+THREADS = 8
+# what a list view renders, for the field projection (search(fields=...))
+LIST_FIELDS = ['canonical_url', 'title', 'image', 'ratings', 'rating_count', 'total_time']
+
+def timed(hydrate, requests, threads=1):
+    """Median and p95 latency (ms) of hydrating every id list in `requests`"""
+    def run(recipe_ids):
+        start = time.perf_counter()
+        hydrate(recipe_ids)
+        return (time.perf_counter() - start) * 1000
+    if threads == 1:
+        latencies = [run(recipe_ids) for recipe_ids in requests]
+    else:
+        with ThreadPoolExecutor(threads) as pool:
+            latencies = list(pool.map(run, requests))
+    return np.median(latencies), np.percentile(latencies, 95)
+
+if __name__ == "__main__":
+    with sqlite3.connect(f'file:{RECIPE_STORE_PATH}?mode=ro', uri=True) as connection:
+        all_ids = [row[0] for row in connection.execute('SELECT id FROM recipes')]
+    shelf = RecipeInfoRetrieval(RECIPE_SHELVES_PATH)
+    store = RecipeStore(RECIPE_STORE_PATH)
+    rng = random.Random(0)
+
+    for k in KS:
+        requests = [rng.sample(all_ids, k) for _ in range(REQUESTS)]
+        assert shelf.get_many(requests[0]) == store.get_many(requests[0])
+        for threads in [1, THREADS]:
+            shelf_median, shelf_p95 = timed(shelf.get_many, requests, threads)
+            store_median, store_p95 = timed(store.get_many, requests, threads)
+            print(f"k={k:>5} threads={threads}: shelf median {shelf_median:8.2f} ms p95 {shelf_p95:8.2f} ms   "
+                  f"store median {store_median:8.2f} ms p95 {store_p95:8.2f} ms   x{shelf_median / store_median:5.1f}")
+
+        # full recipes against LIST_FIELDS only: hydration time, and size and encoding time of the response
+        project = lambda recipe_ids: store.get_many(recipe_ids, LIST_FIELDS)
+        full_median, _ = timed(store.get_many, requests)
+        projected_median, _ = timed(project, requests)
+        full_encode, _ = timed(lambda recipe_ids: json.dumps(store.get_many(recipe_ids)), requests)
+        projected_encode, _ = timed(lambda recipe_ids: json.dumps(project(recipe_ids)), requests)
+        full_bytes = np.mean([len(json.dumps(store.get_many(recipe_ids))) for recipe_ids in requests])
+        projected_bytes = np.mean([len(json.dumps(project(recipe_ids))) for recipe_ids in requests])
+        print(f"k={k:>5} fields: full {full_median:8.2f} ms (+json {full_encode - full_median:6.2f} ms) "
+              f"{full_bytes / 1024:8.1f} KiB   projected {projected_median:8.2f} ms "
+              f"(+json {projected_encode - projected_median:6.2f} ms) {projected_bytes / 1024:8.1f} KiB")
+    store.close()
@@ -0,0 +1,58 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import json
+import random
+import sqlite3
+import time
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+import recipe_store
+from recipe_store import RecipeStore, encode_results
+
+# Time to build the body of a /search/ response with k full recipes: decoding the recipes and letting FastAPI encode
+# the whole result list (what the endpoint did before), against splicing the stored JSON into the body
+# (get_many_raw + encode_results). Run scripts/migrate_recipe_store.py first
+
+# Path FROM THE ROOT OF THE PROJECT
+RECIPE_STORE_PATH = 'files/foodrecipes_store/foodrecipes.sqlite'
+K = 100
+REQUESTS = 50
+
+def fastapi_body(store, hits):
+    # hydration as _filter_and_return does it, encoding as FastAPI's JSONResponse does it
+    recipes = store.get_many([recipe_id for recipe_id, _ in hits])
+    results = {"results": [(recipe_id, score, recipe) for (recipe_id, score), recipe in zip(hits, recipes)]}
+    return json.dumps(jsonable_encoder(results), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+def spliced_body(store, hits):
+    recipes = store.get_many_raw([recipe_id for recipe_id, _ in hits])
+    return encode_results([(recipe_id, score, recipe) for (recipe_id, score), recipe in zip(hits, recipes)])
+
+def timed(build, store, requests):
+    latencies = []
+    for hits in requests:
+        start = time.perf_counter()
+        build(store, hits)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.median(latencies), np.percentile(latencies, 95)
+
+if __name__ == "__main__":
+    with sqlite3.connect(f'file:{RECIPE_STORE_PATH}?mode=ro', uri=True) as connection:
+        all_ids = [row[0] for row in connection.execute('SELECT id FROM recipes')]
+    store = RecipeStore(RECIPE_STORE_PATH)
+    rng = random.Random(0)
+    requests = [[(recipe_id, rng.random()) for recipe_id in rng.sample(all_ids, K)] for _ in range(REQUESTS)]
+    assert json.loads(fastapi_body(store, requests[0])) == json.loads(spliced_body(store, requests[0]))
+
+    print(f"k={K} full recipes, envelope encoded with {'orjson' if recipe_store.orjson is not None else 'json'}")
+    for name, build in [('decode + FastAPI encode', fastapi_body), ('spliced stored JSON', spliced_body)]:
+        median, p95 = timed(build, store, requests)
+        print(f"{name:>24}: median {median:7.2f} ms p95 {p95:7.2f} ms, {len(build(store, requests[0])) / 1024:.1f} KiB")
+    store.close()
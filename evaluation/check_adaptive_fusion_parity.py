@@ -0,0 +1,70 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import numpy as np
+import pandas as pd
+import fusion
+from retrieval import CustomRecipeSearcher
+
+# Checks that the threshold algorithm fusion (adaptive_depth=True) returns the top k of fuse() over the complete
+# rankings of the fixed depth path (rank_ingredients and rank_keywords read to the end), for every strategy of
+# fusion.FUSION_STRATEGIES on the querries that have both ingredients and keywords. Both rank tied documents of
+# a side the same way, so the rank based strategies have to agree as well
+
+# Path FROM THE ROOT OF THE PROJECT
+QUERRIES_PATH = 'evaluation/querries.csv'
+CONTENT_INDEX = 'indexes/content'
+INGREDIENT_INDEX = 'indexes/ingredients_pretokenized'
+INGREDIENT_STATS = 'indexes/stats/ingredients_pretokenized.json'
+CONTENT_STATS = 'indexes/stats/content'
+INGREDIENT_IMPACTS = 'indexes/impacts/ingredients_pretokenized'
+INGREDIENT_SYNONYMS = 'files/other/synonyms.json'
+K = 10
+
+def check_query(searcher: CustomRecipeSearcher, ingredients, keywords, strategy, k=K):
+    """
+    Returns a list of problems, empty when the adaptive top k matches the complete fusion. The
+    two sum the scores of a side in a different order, so the scores are compared with a
+    tolerance and only the documents strictly above the k-th fused score are compared
+    """
+    docids, scores, _ = searcher.rank(ingredients, keywords, k=k, ranking=strategy, adaptive_depth=True)
+    ingredient_ranked = searcher.ingredient_searcher.rank_ingredients(ingredients, k="all")
+    keyword_ranked = searcher._rank_keywords(keywords, "all")
+    expected_docids, expected_scores = fusion.fuse([ingredient_ranked, keyword_ranked], k, strategy)
+    if len(expected_docids) != len(docids):
+        return [f"{len(expected_docids)} results expected, got {len(docids)}"]
+    if len(docids) == 0:
+        return []
+    problems = []
+    if not np.allclose(expected_scores, scores, rtol=1e-9, atol=0):
+        problems.append(f"fused scores differ by up to {np.max(np.abs(expected_scores - scores))}")
+    cutoff = expected_scores[-1]
+    expected_ids = set(expected_docids[expected_scores > cutoff + 1e-9 * abs(cutoff)].tolist())
+    if not expected_ids <= set(docids.tolist()):
+        problems.append(f"{len(expected_ids - set(docids.tolist()))} documents missing from the top {k}")
+    return problems
+
+if __name__ == "__main__":
+    querries = pd.read_csv(QUERRIES_PATH)
+    queries = [(row['ingredients'], row['keywords']) for _, row in querries.iterrows()
+               if not pd.isna(row['ingredients']) and not pd.isna(row['keywords'])]
+    searcher = CustomRecipeSearcher(content_path=CONTENT_INDEX,
+                                    ingredient_path=INGREDIENT_INDEX,
+                                    index_stats_path=INGREDIENT_STATS,
+                                    synonym_path=INGREDIENT_SYNONYMS,
+                                    impact_path=INGREDIENT_IMPACTS if os.path.isdir(INGREDIENT_IMPACTS) else None,
+                                    content_stats_path=CONTENT_STATS)
+    failed = 0
+    for strategy in fusion.FUSION_STRATEGIES:
+        for ingredients, keywords in queries:
+            problems = check_query(searcher, ingredients, keywords, strategy)
+            if problems:
+                failed += 1
+                print(f"[FAIL] {strategy} {ingredients!r} / {keywords!r}: " + "; ".join(problems))
+    total = len(queries) * len(fusion.FUSION_STRATEGIES)
+    print(f"{total - failed}/{total} adaptive fusions match the complete fusion")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,61 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import numpy as np
+import pandas as pd
+from retrieval import RecipeSearcher
+
+# Path FROM THE ROOT OF THE PROJECT
+QUERRIES_PATH = 'evaluation/querries.csv'
+CONTENT_INDEX = 'indexes/content'
+CONTENT_STATS = 'indexes/stats/content'
+K = 1000
+BATCH_SIZE = 16
+
+def check_batch(searcher: RecipeSearcher, queries, k=K, doc_masks=None):
+    """
+    Compares the batched Dirichlet ranking (rank_keywords_batch, one sparse product for the
+    whole batch) with rank_keywords run query by query. Returns a list of problems, empty
+    when both agree. The two sum the log likelihoods in a different order, so the scores are
+    compared with a tolerance and, like in check_dirichlet_parity.py, only the documents
+    strictly above the score of the last returned result
+    """
+    if doc_masks is None:
+        doc_masks = [None] * len(queries)
+    batch = searcher.rank_keywords_batch(queries, k, doc_masks)
+    problems = []
+    for query, doc_mask, (docids, scores) in zip(queries, doc_masks, batch):
+        expected_docids, expected_scores = searcher.rank_keywords(query, k=k, doc_mask=doc_mask)
+        if len(expected_docids) != len(docids):
+            problems.append(f"{query!r}: {len(expected_docids)} results expected, got {len(docids)}")
+            continue
+        if len(docids) == 0:
+            continue
+        if not np.allclose(expected_scores, scores, rtol=1e-9, atol=0):
+            problems.append(f"{query!r}: scores differ by up to {np.max(np.abs(expected_scores - scores))}")
+        cutoff = expected_scores[-1]
+        expected_ids = set(expected_docids[expected_scores > cutoff + 1e-9 * abs(cutoff)].tolist())
+        if not expected_ids <= set(docids.tolist()):
+            problems.append(f"{query!r}: {len(expected_ids - set(docids.tolist()))} documents missing from the top {k}")
+    return problems
+
+if __name__ == "__main__":
+    querries = pd.read_csv(QUERRIES_PATH)
+    keywords = [kw for kw in querries['keywords'] if not pd.isna(kw) and kw.strip() != ""]
+    searcher = RecipeSearcher(CONTENT_INDEX, stats_path=CONTENT_STATS)
+    # every other document, to check the doc_mask path as well
+    half = np.arange(len(searcher.content_stats['dl'])) % 2 == 0
+
+    problems = []
+    for start in range(0, len(keywords), BATCH_SIZE):
+        batch = keywords[start:start + BATCH_SIZE]
+        problems += check_batch(searcher, batch)
+        problems += check_batch(searcher, batch, doc_masks=[half if i % 2 else None for i in range(len(batch))])
+    for problem in problems:
+        print(f"[FAIL] {problem}")
+    print(f"{len(keywords)} queries, {len(problems)} differences between the batched and the single query ranking")
+    sys.exit(1 if problems else 0)
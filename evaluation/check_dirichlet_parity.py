@@ -0,0 +1,62 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory 
+if path not in sys.path:
+    sys.path.append(path)
+
+import numpy as np
+import pandas as pd
+from retrieval import RecipeSearcher
+
+# Path FROM THE ROOT OF THE PROJECT
+QUERRIES_PATH = 'evaluation/querries.csv'
+CONTENT_INDEX = 'indexes/content'
+CONTENT_STATS = 'indexes/stats/content'
+K = 1000
+
+def check_query(searcher: RecipeSearcher, query, k=K):
+    """
+    Compares the vectorised Dirichlet ranking with the original loop for one query.
+    Returns a list of problems, empty when both agree. Documents tied on the score
+    of the last returned result may legitimately differ, so only the ids strictly
+    above that score are compared.
+    """
+    reader = searcher.content_reader
+    docinfo = searcher.content_stats
+    query_terms = reader.analyze(query)
+    postings = {term: searcher._postings(term) for term in set(query_terms)}
+    # the loop scores unknown terms as -inf for every document, the vectorised version drops them
+    query_terms = [term for term in query_terms if len(postings[term][0]) > 0]
+
+    expected = searcher._dirichlet_rank_loop(query_terms, postings, reader, docinfo, k)
+    actual = searcher._with_iids(*searcher._dirichlet_rank(query_terms, postings, reader, docinfo, k))
+    problems = []
+    if len(expected) != len(actual):
+        return [f"{len(expected)} results expected, got {len(actual)}"]
+    if not expected:
+        return problems
+    expected_scores = np.array([score for _, score in expected])
+    actual_scores = np.array([score for _, score in actual])
+    if not np.allclose(expected_scores, actual_scores, rtol=1e-9, atol=0):
+        problems.append(f"scores differ by up to {np.max(np.abs(expected_scores - actual_scores))}")
+    cutoff = expected_scores[-1]
+    expected_ids = {docid for docid, score in expected if score > cutoff + 1e-9 * abs(cutoff)}
+    actual_ids = {docid for docid, _ in actual}
+    if not expected_ids <= actual_ids:
+        problems.append(f"{len(expected_ids - actual_ids)} documents missing from the top {k}")
+    return problems
+
+if __name__ == "__main__":
+    querries = pd.read_csv(QUERRIES_PATH)
+    keywords = [kw for kw in querries['keywords'] if not pd.isna(kw) and kw.strip() != ""]
+    searcher = RecipeSearcher(CONTENT_INDEX, stats_path=CONTENT_STATS)
+
+    failed = 0
+    for query in keywords:
+        problems = check_query(searcher, query)
+        if problems:
+            failed += 1
+            print(f"[FAIL] {query!r}: " + "; ".join(problems))
+    print(f"{len(keywords) - failed}/{len(keywords)} queries match the reference implementation")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,52 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import tempfile
+import time
+
+import numpy as np
+from retrieval import artifacts_version
+from scripts.generate_index_statistics import save_array
+
+# Checks what a rebuild of a derived artifact does to a running API: the file a worker memory mapped keeps its
+# old contents (the scripts replace files instead of overwriting them), and the version of the files on disk
+# changes, which /cache/stats reports as restart_needed. Works on a throwaway directory standing in for a derived
+# artifact, not on the real indexes
+
+def check_rebuild():
+    """Returns a list of problems, empty when a rebuild leaves mapped files intact and changes the version"""
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        ingredient_index, content_index, artifact = (os.path.join(directory, name)
+                                                     for name in ('ingredients', 'content', 'attributes'))
+        for d in (ingredient_index, content_index, artifact):
+            os.makedirs(d)
+        column = os.path.join(artifact, 'column.npy')
+        save_array(column, np.arange(1000, dtype=np.float64))
+        loaded_version = artifacts_version(ingredient_index, content_index, [artifact])
+        mapped = np.load(column, mmap_mode='r')
+
+        # the artifact is rebuilt while a worker has it mapped, with fewer rows
+        later = time.time() + 1
+        save_array(column, np.zeros(10))
+        os.utime(column, (later, later))
+        if float(mapped[-1]) != 999.0:
+            problems.append("the mapped column changed under the worker")
+        if os.path.exists(column + '.tmp'):
+            problems.append("the temporary file was left behind")
+        if len(np.load(column)) != 10:
+            problems.append("the rebuilt column was not written")
+        if artifacts_version(ingredient_index, content_index, [artifact]) == loaded_version:
+            problems.append("rebuilding an artifact does not change the version, restart_needed stays false")
+        del mapped
+    return problems
+
+if __name__ == "__main__":
+    problems = check_rebuild()
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    print("rebuild check:", "ok" if not problems else f"{len(problems)} problems")
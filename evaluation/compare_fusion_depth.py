@@ -0,0 +1,88 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import time
+
+import numpy as np
+import pandas as pd
+from retrieval import CustomRecipeSearcher
+from metrics import POSTINGS_TOUCHED, CANDIDATES_SCORED
+
+# Compares the fixed k*10 retrieval depth with the threshold algorithm fusion (adaptive_depth=True) on the
+# querries that have both ingredients and keywords: how deep every side is read, how much work (postings read
+# and documents scored, from the metrics counters) and time it takes, and how much of the top k changes. The
+# work is also split between the easy queries, whose top k is final after EASY_ROUNDS rounds of the threshold
+# algorithm, and the others
+
+# Path FROM THE ROOT OF THE PROJECT
+QUERRIES_PATH = 'evaluation/querries.csv'
+CONTENT_INDEX = 'indexes/content'
+INGREDIENT_INDEX = 'indexes/ingredients_pretokenized'
+INGREDIENT_STATS = 'indexes/stats/ingredients_pretokenized.json'
+CONTENT_STATS = 'indexes/stats/content'
+INGREDIENT_IMPACTS = 'indexes/impacts/ingredients_pretokenized'
+INGREDIENT_SYNONYMS = 'files/other/synonyms.json'
+K = 10
+EASY_ROUNDS = 2
+RANKINGS = ['simple', 'rrf', 'reciprocal_rank', 'combmnz']
+
+def work():
+    """(postings touched, candidates scored) so far, both sides"""
+    return (sum(POSTINGS_TOUCHED.value(side) for side in ('ingredients', 'keywords')),
+            sum(CANDIDATES_SCORED.value(side) for side in ('ingredients', 'keywords')))
+
+def compare(searcher: CustomRecipeSearcher, queries, ranking, k=K):
+    fixed_time, adaptive_time = 0.0, 0.0
+    fixed_depths, depths, overlaps, gains = [], [], [], []
+    # per query: (postings, candidates) of the fixed and of the adaptive search, rounds of the adaptive one
+    fixed_work, adaptive_work, rounds = [], [], []
+    for ingredients, keywords in queries:
+        before = work()
+        start = time.perf_counter()
+        fixed = searcher.search(ingredients, keywords, k=k, ranking=ranking)
+        fixed_time += time.perf_counter() - start
+        fixed_work.append(np.subtract(work(), before))
+        fixed_depths.append(searcher.last_fusion_stats['depths'])
+
+        before = work()
+        start = time.perf_counter()
+        adaptive = searcher.search(ingredients, keywords, k=k, ranking=ranking, adaptive_depth=True)
+        adaptive_time += time.perf_counter() - start
+        adaptive_work.append(np.subtract(work(), before))
+        depths.append(searcher.last_fusion_stats['depths'])
+        rounds.append(searcher.last_fusion_stats.get('rounds', 0))
+
+        overlaps.append(len({d for d, _ in fixed} & {d for d, _ in adaptive}) / max(len(fixed), 1))
+        # the threshold algorithm works on the complete rankings, its top k can only score higher
+        gains.append(sum(s for _, s in adaptive) - sum(s for _, s in fixed))
+
+    fixed_depths, depths = np.array(fixed_depths), np.array(depths)
+    fixed_work, adaptive_work, rounds = np.array(fixed_work), np.array(adaptive_work), np.array(rounds)
+    print(f"{ranking:>15}: fixed median {np.median(fixed_depths[:, 0]):.0f} / {np.median(fixed_depths[:, 1]):.0f}, "
+          f"adaptive median {np.median(depths[:, 0]):.0f} / {np.median(depths[:, 1]):.0f}, max {depths[:, 0].max()} / {depths[:, 1].max()} (ingredients / keywords)")
+    print(f"{'':>15}  top {k} overlap {np.mean(overlaps):.2f}, queries where adaptive scores higher "
+          f"{sum(g > 1e-12 for g in gains)}/{len(gains)}, "
+          f"time fixed {fixed_time * 1000 / len(queries):.1f} ms vs adaptive {adaptive_time * 1000 / len(queries):.1f} ms")
+    for name, selected in (('easy', rounds <= EASY_ROUNDS), ('other', rounds > EASY_ROUNDS)):
+        if not selected.any():
+            continue
+        fixed_mean, adaptive_mean = fixed_work[selected].mean(axis=0), adaptive_work[selected].mean(axis=0)
+        print(f"{'':>15}  {name} ({selected.sum()} queries): postings fixed {fixed_mean[0]:.0f} vs adaptive "
+              f"{adaptive_mean[0]:.0f}, documents scored fixed {fixed_mean[1]:.0f} vs adaptive {adaptive_mean[1]:.0f} per query")
+
+if __name__ == "__main__":
+    querries = pd.read_csv(QUERRIES_PATH)
+    queries = [(row['ingredients'], row['keywords']) for _, row in querries.iterrows()
+               if not pd.isna(row['ingredients']) and not pd.isna(row['keywords'])]
+    searcher = CustomRecipeSearcher(content_path=CONTENT_INDEX,
+                                    ingredient_path=INGREDIENT_INDEX,
+                                    index_stats_path=INGREDIENT_STATS,
+                                    synonym_path=INGREDIENT_SYNONYMS,
+                                    impact_path=INGREDIENT_IMPACTS if os.path.isdir(INGREDIENT_IMPACTS) else None,
+                                    content_stats_path=CONTENT_STATS)
+    for ranking in RANKINGS:
+        compare(searcher, queries, ranking)
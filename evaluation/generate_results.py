@@ -9,7 +9,6 @@ if path not in sys.path:
 
 from retrieval import CustomRecipeSearcher
 import pandas as pd
-from tqdm import tqdm
 
 # Method to generate results for the search engine
 COMBINING_METHOD = 'simple' # or 'rrf'
@@ -20,6 +19,7 @@ OUTPUT_JSON_PATH = 'evaluation/results.json'
 CONTENT_INDEX = 'indexes/content'
 INGREDIENT_INDEX = 'indexes/ingredients_pretokenized'
 INGREDIENT_STATS = 'indexes/stats/ingredients_pretokenized.json'
+CONTENT_STATS = 'indexes/stats/content'
 INGREDIENT_SYNONYMS = 'files/other/synonyms.json'
 
 
@@ -28,8 +28,8 @@ def load_queries(querries_path):
     return querries
 
 def generate_results(searcher: CustomRecipeSearcher, querries, n_results=10):
-    result_list = []
-    for index, row in tqdm(querries.iterrows(), total=len(querries)):
+    queries = []
+    for index, row in querries.iterrows():
         ingredients = row['ingredients']
         keywords = row['keywords']
         
@@ -38,9 +38,12 @@ def generate_results(searcher: CustomRecipeSearcher, querries, n_results=10):
         
         if pd.isna(keywords):
             keywords = ""
-        
-        result = searcher.search(ingredients_str=ingredients, keywords_str=keywords,
-                                 k=n_results, ranking=COMBINING_METHOD)
+        queries.append((ingredients, keywords))
+    
+    # all querries are scored in one batch, the results are the same as calling searcher.search one by one
+    results = searcher.search_batch(queries, k=n_results, ranking=COMBINING_METHOD)
+    result_list = []
+    for (ingredients, keywords), result in zip(queries, results):
         result_list.append({
             'ingredients': ingredients,
             'keywords': keywords,
@@ -59,7 +62,8 @@ if __name__ == "__main__":
     searcher = CustomRecipeSearcher(content_path=CONTENT_INDEX,
                                     ingredient_path=INGREDIENT_INDEX,
                                     index_stats_path=INGREDIENT_STATS,
-                                    synonym_path=INGREDIENT_SYNONYMS)
+                                    synonym_path=INGREDIENT_SYNONYMS,
+                                    content_stats_path=CONTENT_STATS)
     
     # Generate the results
     generate_results(searcher, querries)
\ No newline at end of file
@@ -0,0 +1,80 @@
+import os, sys
+
+path = os.path.abspath(os.curdir)
+# change the current directory
+if path not in sys.path:
+    sys.path.append(path)
+
+import multiprocessing
+
+import pandas as pd
+
+# Memory of API worker processes, with and without the memory-mapped doc table (scripts/build_doc_table.py).
+# Starts WORKERS processes at the same time, each builds the searcher like main.py and answers the querries, then
+# they report their memory from /proc (Linux only) while all of them are still alive:
+#   USS (private pages) is what every additional worker costs,
+#   PSS counts the shared pages (mapped index files, libraries) once, split between the workers
+
+# Path FROM THE ROOT OF THE PROJECT
+QUERRIES_PATH = 'evaluation/querries.csv'
+CONTENT_INDEX = 'indexes/content'
+INGREDIENT_INDEX = 'indexes/ingredients_pretokenized'
+INGREDIENT_STATS = 'indexes/stats/ingredients_pretokenized.json'
+CONTENT_STATS = 'indexes/stats/content'
+INGREDIENT_IMPACTS = 'indexes/impacts/ingredients_pretokenized'
+INGREDIENT_LEMMAS = 'indexes/stats/ingredient_lemmas.json'
+INGREDIENT_SYNONYMS_STORE = 'files/other/synonyms_store'
+ATTRIBUTES = 'indexes/attributes'
+DOC_TABLE = 'indexes/doc_table'
+WORKERS = 4
+
+def memory():
+    """{Rss, Pss, Uss} of the calling process in MiB"""
+    values = {}
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'Rss': values['Rss'],
+        'Pss': values['Pss'],
+        'Uss': values['Private_Clean'] + values['Private_Dirty'],
+    }
+
+def worker(doc_table_path, queries, results, done):
+    from retrieval import CustomRecipeSearcher
+    searcher = CustomRecipeSearcher(CONTENT_INDEX, INGREDIENT_INDEX, INGREDIENT_STATS,
+                                    synonym_path=INGREDIENT_SYNONYMS_STORE,
+                                    impact_path=INGREDIENT_IMPACTS if os.path.isdir(INGREDIENT_IMPACTS) else None,
+                                    lemma_path=INGREDIENT_LEMMAS if os.path.exists(INGREDIENT_LEMMAS) else None,
+                                    content_stats_path=CONTENT_STATS,
+                                    attributes_path=ATTRIBUTES,
+                                    doc_table_path=doc_table_path)
+    for ingredients, keywords in queries:
+        searcher.search(ingredients, keywords, k=10)
+    results.put(memory())
+    # stay alive until every worker has measured, so the shared pages are shared while PSS is read
+    done.wait()
+
+def measure(doc_table_path, queries, workers=WORKERS):
+    # spawn and not fork, like uvicorn does for its workers: nothing is inherited from this process
+    context = multiprocessing.get_context('spawn')
+    results, done = context.Queue(), context.Event()
+    processes = [context.Process(target=worker, args=(doc_table_path, queries, results, done)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in processes]
+    done.set()
+    for process in processes:
+        process.join()
+    return {key: sum(m[key] for m in measurements) / len(measurements) for key in measurements[0]}
+
+if __name__ == "__main__":
+    querries = pd.read_csv(QUERRIES_PATH)
+    queries = [("" if pd.isna(row['ingredients']) else row['ingredients'],
+                "" if pd.isna(row['keywords']) else row['keywords']) for _, row in querries.iterrows()]
+    for name, doc_table_path in [('index statistics', None), ('doc table', DOC_TABLE)]:
+        mean = measure(doc_table_path, queries)
+        print(f"{name:>16}: per worker USS {mean['Uss']:8.1f} MiB   PSS {mean['Pss']:8.1f} MiB   "
+              f"RSS {mean['Rss']:8.1f} MiB   ({WORKERS} workers)")
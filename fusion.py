@@ -0,0 +1,272 @@
+import numpy as np
+
+# Fusion of the ingredient and keyword result lists. A ranked list is a pair of numpy arrays (docids, scores)
+# sorted by descending score, docids have to live in the same id space for every list that is fused.
+
+# constant of reciprocal rank fusion, the value used by Cormack et al.
+RRF_K = 60
+
+def sigmoid(x):
+    with np.errstate(over='ignore'):
+        return 1.0 / (1.0 + np.exp(-x))
+
+def top_k_indices(scores, k):
+    """Indices of the k largest scores, ordered by descending score. Ties are broken by the lower index, so the
+    selection does not depend on how argpartition happens to split equal scores"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+# Per-list normalisations, they get the scores of one list, the 1-based ranks of its documents and the lowest and
+# highest score of the list. All of them are non-negative and do not increase further down the list, which is
+# what threshold_fuse relies on
+
+def _sigmoid_scores(scores, ranks, low, high):
+    return sigmoid(scores)
+
+def _rank_scaled_scores(scores, ranks, low, high):
+    return sigmoid(scores) / ranks
+
+def _reciprocal_rank_scores(scores, ranks, low, high):
+    return 1.0 / (RRF_K + ranks)
+
+def _min_max_scores(scores, ranks, low, high):
+    if high == low:
+        return np.ones(len(scores))
+    return (scores - low) / (high - low)
+
+# name -> (per-list normalisation, multiply the sum by the number of lists that contain the document,
+#          the normalisation needs the ranks)
+FUSION_STRATEGIES = {
+    # sum of the sigmoid of the scores
+    'simple': (_sigmoid_scores, False, False),
+    # sum of sigmoid(score) / rank, 'rrf' is the name the API has always used for it
+    'rrf': (_rank_scaled_scores, False, True),
+    'rank_scaled': (_rank_scaled_scores, False, True),
+    # reciprocal rank fusion, sum of 1 / (60 + rank)
+    'reciprocal_rank': (_reciprocal_rank_scores, False, True),
+    # sum / sum times number of hits of the min-max normalised scores
+    'combsum': (_min_max_scores, False, False),
+    'combmnz': (_min_max_scores, True, False),
+}
+
+# used when no strategy is given (None)
+DEFAULT_STRATEGY = 'simple'
+
+def get_strategy(name):
+    if name is None:
+        name = DEFAULT_STRATEGY
+    if name not in FUSION_STRATEGIES:
+        raise ValueError(f"Unknown fusion strategy '{name}', expected one of {', '.join(FUSION_STRATEGIES)}")
+    return FUSION_STRATEGIES[name]
+
+def reads_scores_only(name):
+    """True when the strategy normalises a score by itself, without its rank or the lowest score of the complete
+    list, so its lists can be RankedLists that are only ranked as deep as threshold_fuse reads them"""
+    normalise, _, uses_ranks = get_strategy(name)
+    return not uses_ranks and normalise is not _min_max_scores
+
+def fuse(ranked_lists, k, strategy='simple'):
+    """
+    Fuses ranked lists into their top k with the given strategy. A document missing from a
+    list gets nothing from it. Returns the fused (docids, scores), best first.
+    """
+    normalise, multiply_hits, _ = get_strategy(strategy)
+    docid_blocks, score_blocks = [], []
+    for docids, scores in ranked_lists:
+        scores = np.asarray(scores, dtype=float)
+        if len(scores) == 0:
+            continue
+        ranks = np.arange(1, len(docids) + 1)
+        docid_blocks.append(np.asarray(docids))
+        score_blocks.append(normalise(scores, ranks, scores.min(), scores.max()))
+
+    if not docid_blocks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+    all_docids = np.concatenate(docid_blocks)
+    docids, inverse = np.unique(all_docids, return_inverse=True)
+    fused = np.bincount(inverse, weights=np.concatenate(score_blocks), minlength=len(docids))
+    if multiply_hits:
+        fused *= np.bincount(inverse, minlength=len(docids))
+
+    order = top_k_indices(fused, k)
+    return docids[order], fused[order]
+
+# threshold_fuse reads two kinds of lists with the same methods: top(depth) is the sorted access (docids of the
+# `depth` best documents), contributions(docids, ...) the random access ((found mask, normalised scores) of any
+# documents), bound(depth, ...) the largest contribution left below the first `depth` documents and
+# exhausted(depth) whether those are the whole list
+
+class CandidateList:
+    """Every candidate of one sub-searcher with its score, in no particular order, the input of threshold_fuse.
+    Gives the two kinds of access of the threshold algorithm: sorted access walks the list best first (the prefix
+    is selected with a partition and only grows when asked for), random access finds the score of any document
+    with a binary search over the docids. Ties are ranked by the lower `tiebreak` value, the docid by default:
+    a sub-searcher that ranks in another id space passes its own ids, so the ranks match its rankings"""
+
+    def __init__(self, docids, scores, tiebreak=None):
+        docids = np.asarray(docids)
+        # positions follow the tie order, top_k_indices and ranks() break ties by the lower position
+        order = np.argsort(docids if tiebreak is None else np.asarray(tiebreak), kind='stable')
+        self.docids = docids[order]
+        self.scores = np.asarray(scores, dtype=float)[order]
+        # positions by docid, for the random access
+        self._by_docid = np.argsort(self.docids, kind='stable')
+        self._sorted_docids = self.docids[self._by_docid]
+        self.low = self.scores.min() if len(self.scores) else 0.0
+        self.high = self.scores.max() if len(self.scores) else 0.0
+        # positions of the best documents, best first
+        self._prefix = np.empty(0, dtype=np.int64)
+        self._ranks = None
+
+    def __len__(self):
+        return len(self.docids)
+
+    def prefix(self, depth):
+        """Positions of the `depth` best documents, best first"""
+        if depth > len(self._prefix) and len(self._prefix) < len(self):
+            # grow geometrically, so walking down the list costs a few partitions and not one per block
+            self._prefix = top_k_indices(self.scores, max(depth, 2 * len(self._prefix)))
+        return self._prefix[:depth]
+
+    def top(self, depth):
+        return self.docids[self.prefix(depth)]
+
+    def ranked(self, depth):
+        """(docids, scores) of the `depth` best documents, best first"""
+        positions = self.prefix(depth)
+        return self.docids[positions], self.scores[positions]
+
+    def exhausted(self, depth):
+        return depth >= len(self)
+
+    def ranks(self, positions):
+        # the rank of a document that was not reached by sorted access needs the whole order, computed once
+        if self._ranks is None:
+            self._ranks = np.empty(len(self), dtype=np.int64)
+            self._ranks[np.lexsort((np.arange(len(self)), -self.scores))] = np.arange(1, len(self) + 1)
+        return self._ranks[positions]
+
+    def lookup(self, docids):
+        """(found mask, positions) of `docids`, positions are only meaningful where found"""
+        if not len(self):
+            return np.zeros(len(docids), dtype=bool), np.zeros(len(docids), dtype=np.int64)
+        index = np.minimum(np.searchsorted(self._sorted_docids, docids), len(self) - 1)
+        return self._sorted_docids[index] == docids, self._by_docid[index]
+
+    def contributions(self, docids, normalise, uses_ranks):
+        found, positions = self.lookup(docids)
+        positions = positions[found]
+        ranks = self.ranks(positions) if uses_ranks else None
+        return found, normalise(self.scores[positions], ranks, self.low, self.high)
+
+    def bound(self, depth, normalise):
+        """Largest contribution of a document below the first `depth` ones, 0 once the list is exhausted"""
+        if depth >= len(self):
+            return 0.0
+        position = self.prefix(depth + 1)[depth:]
+        return float(normalise(self.scores[position], np.array([depth + 1]), self.low, self.high)[0])
+
+class RankedList:
+    """A ranking that is only computed as deep as threshold_fuse reads it, for a sub-searcher that can rank its
+    top n without scoring every candidate (MaxScore). fetch(n) returns the (docids, scores) of the n best
+    documents, best first and fewer once the ranking is exhausted, score(docids) the (found mask, scores) of any
+    documents. A fetch goes twice as deep as the read that needs it, so the next round of threshold_fuse (which
+    doubles its depth) is served without fetching again. The ranks and the lowest score of the complete ranking
+    stay unknown, only strategies for which reads_scores_only() holds can read it"""
+
+    def __init__(self, fetch, score):
+        self._fetch = fetch
+        self._score = score
+        self.docids = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0, dtype=float)
+        self._complete = False
+        self.fetches = 0
+
+    def __len__(self):
+        # the documents fetched so far, all of them once exhausted
+        return len(self.docids)
+
+    def _read(self, depth):
+        if depth > len(self.docids) and not self._complete:
+            n = 2 * max(depth, len(self.docids))
+            docids, scores = self._fetch(n)
+            self.docids, self.scores = np.asarray(docids), np.asarray(scores, dtype=float)
+            self._complete = len(self.docids) < n
+            self.fetches += 1
+
+    def top(self, depth):
+        self._read(depth)
+        return self.docids[:depth]
+
+    def ranked(self, depth):
+        """(docids, scores) of the `depth` best documents, best first"""
+        self._read(depth)
+        return self.docids[:depth], self.scores[:depth]
+
+    def exhausted(self, depth):
+        self._read(depth)
+        return self._complete and depth >= len(self.docids)
+
+    def contributions(self, docids, normalise, uses_ranks):
+        found, scores = self._score(docids)
+        return found, normalise(np.asarray(scores, dtype=float)[found], None, None, None)
+
+    def bound(self, depth, normalise):
+        """Contribution of the last document read: the ones below it score at most as much, 0 once exhausted"""
+        if self.exhausted(depth):
+            return 0.0
+        return float(normalise(self.scores[depth - 1:depth], None, None, None)[0])
+
+def threshold_fuse(candidate_lists, k, strategy='simple', initial_depth=None):
+    """
+    Fagin's threshold algorithm over CandidateLists and RankedLists. The lists are read best first, the depth
+    doubling every round (starting at `initial_depth`, k by default); every document seen so far is scored on
+    all lists by random access. A document that has not been seen yet can at most get the contributions of the
+    last read position of every list, so once the k-th fused score reaches that threshold the top k is final and
+    the rest of the lists is never looked at, a RankedList is never ranked deeper. Gives the same top k as fuse()
+    over the complete lists, up to the order of documents tied on the fused score (min-max strategies normalise
+    over the complete lists).
+    Returns (docids, scores, stats), stats holding the depth read from every list and how many documents every
+    list ranked (the complete CandidateLists, what the RankedLists fetched).
+    """
+    normalise, multiply_hits, uses_ranks = get_strategy(strategy)
+    depth = max(initial_depth if initial_depth is not None else k, 1)
+    rounds = 0
+    while True:
+        rounds += 1
+        seen = np.unique(np.concatenate(
+            [np.empty(0, dtype=np.int64)] + [lst.top(depth) for lst in candidate_lists]))
+        fused = np.zeros(len(seen))
+        hits = np.zeros(len(seen), dtype=np.int64)
+        for lst in candidate_lists:
+            found, contributions = lst.contributions(seen, normalise, uses_ranks)
+            fused[found] += contributions
+            hits[found] += 1
+        if multiply_hits:
+            fused *= hits
+        threshold = sum(lst.bound(depth, normalise) for lst in candidate_lists)
+        if multiply_hits:
+            threshold *= len(candidate_lists)
+
+        exhausted = all(lst.exhausted(depth) for lst in candidate_lists)
+        if k <= 0 or exhausted or (k <= len(seen) and np.partition(fused, len(fused) - k)[len(fused) - k] >= threshold):
+            break
+        depth *= 2
+
+    order = top_k_indices(fused, k)
+    stats = {
+        'depths': [min(depth, len(lst)) for lst in candidate_lists],
+        'list_sizes': [len(lst) for lst in candidate_lists],
+        'candidates': len(seen),
+        'rounds': rounds,
+    }
+    return seen[order], fused[order], stats
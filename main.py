@@ -1,34 +1,276 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
-from retrieval import CustomRecipeSearcher
+from fastapi import FastAPI, Header, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Literal
+from retrieval import CustomRecipeSearcher, InvalidCursorError, FacetsUnavailableError
+from fusion import FUSION_STRATEGIES, DEFAULT_STRATEGY
+from recipe_store import encode_result, encode_results
+from search_pool import SearchPool, PoolFullError
+from caching import ResultCache, canonical_ingredients, canonical_keywords
+from scripts.build_synonym_store import TOP_N as MAX_NSYMS
+from metrics import REGISTRY
+from profiling import SamplingProfiler, profile_path, prune_profiles, is_enabled
 import json
+import os
 
 CONTENT_INDEX = 'indexes/content'
 INGREDIENT_INDEX = 'indexes/ingredients_pretokenized'
 INGREDIENT_STATS = 'indexes/stats/ingredients_pretokenized.json'
+CONTENT_STATS = 'indexes/stats/content'
+INGREDIENT_IMPACTS = 'indexes/impacts/ingredients_pretokenized'
+INGREDIENT_LEMMAS = 'indexes/stats/ingredient_lemmas.json'
 INGREDIENT_SYNONYMS = 'files/other/synonyms.json'
+INGREDIENT_SYNONYMS_STORE = 'files/other/synonyms_store'
+ATTRIBUTES = 'indexes/attributes'
+DOC_TABLE = 'indexes/doc_table'
 RECIPE_SHELVES_PATH = 'files/foodrecipes_shelves/foodrecipes_shelves.db'
+RECIPE_STORE_PATH = 'files/foodrecipes_store/foodrecipes.sqlite'
+# threads shared by all requests for the ingredient / keyword sides of a search, and how long (seconds) a side
+# may take before the search answers without it. None waits for both sides
+SEARCH_WORKERS = 8
+INGREDIENT_TIMEOUT = None
+KEYWORD_TIMEOUT = None
+# requests (searches, facets) that run at once off the event loop, and how many may wait for one of them. Requests
+# beyond that are answered with 503 and Retry-After (seconds) right away
+REQUEST_WORKERS = 4
+REQUEST_QUEUE = 32
+RETRY_AFTER = 1
+# finished /search/ responses, by canonical query. Entries expire after RESULT_CACHE_TTL seconds
+RESULT_CACHE_ENTRIES = 10000
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL = 600
+# paginated searches (page_size or cursor): how deep the query is ranked once for all its pages, the largest page
+# and how long (seconds) the ranking is kept after a page was read. The cursors are signed with
+# RECIPE_SEARCH_CURSOR_KEY, which serve.py shares between its workers; without it they only work on the worker
+# that issued them
+MAX_PAGINATED_RESULTS = 500
+MAX_PAGE_SIZE = 100
+CURSOR_TTL = 300
+CURSOR_KEY = os.environ.get('RECIPE_SEARCH_CURSOR_KEY')
+# /search/stream: results when the request has no k, the most results one request may ask for, and how many
+# recipes are hydrated and written at once
+STREAM_RESULTS = 1000
+MAX_STREAM_RESULTS = 10000
+STREAM_CHUNK = 500
+# the most searches one /search/batch request may contain
+MAX_BATCH_SEARCHES = 20
+# With RECIPE_SEARCH_PROFILING=1 in the environment, /search/ requests with "profile": true or "X-Profile: true"
+# are profiled (profiling.py) and their collapsed stacks written to PROFILE_DIR, which keeps the last MAX_PROFILES.
+# The response names the file in its X-Profile header. Off by default: anyone who can reach the API could make
+# the server profile and write files
+ALLOW_PROFILING = is_enabled(os.environ.get('RECIPE_SEARCH_PROFILING'))
+PROFILE_DIR = 'profiles'
+MAX_PROFILES = 100
 
 class Search(BaseModel):
     ingredients: str
     keywords: str | None = ""
-    type: str | None = "simple"
+    # fusion strategy, see fusion.FUSION_STRATEGIES. null is the default one, unknown names are rejected (422)
+    type: Literal[tuple(FUSION_STRATEGIES)] | None = DEFAULT_STRATEGY
     include_full_recipes: bool = False
+    # only return these recipe fields, e.g. ["title", "image", "ratings"], implies include_full_recipes
+    fields: list[str] | None = None
     time_range: list[float] | None = None
     serving_size_range: list[float] | None = None
     calories_range: list[float] | None = None
+    # synonyms added per query ingredient, at most MAX_NSYMS (422 above): the synonym store only keeps that many
+    nsyms: int = Field(5, ge=0, le=MAX_NSYMS)
+    # number of results of /search/stream (STREAM_RESULTS when not given), /search/ always returns 10
+    k: int | None = None
+    # pagination: page_size starts a paginated search, the response has the cursor of the next page (next_cursor,
+    # null on the last one). A request with a cursor gets that page, its other fields are ignored
+    page_size: int | None = None
+    cursor: str | None = None
+    # profile this search, see ALLOW_PROFILING
+    profile: bool = False
 
 # Initialize the FastAPI app    
 app = FastAPI()
 # Initialize the search engine and load recipes
-engine = CustomRecipeSearcher(CONTENT_INDEX, INGREDIENT_INDEX, INGREDIENT_STATS, synonym_path=INGREDIENT_SYNONYMS, recipe_path=RECIPE_SHELVES_PATH)
+engine = CustomRecipeSearcher(CONTENT_INDEX, INGREDIENT_INDEX, INGREDIENT_STATS,
+                              synonym_path=INGREDIENT_SYNONYMS_STORE if os.path.isdir(INGREDIENT_SYNONYMS_STORE) else INGREDIENT_SYNONYMS,
+                              recipe_path=RECIPE_STORE_PATH if os.path.exists(RECIPE_STORE_PATH) else RECIPE_SHELVES_PATH,
+                              impact_path=INGREDIENT_IMPACTS if os.path.isdir(INGREDIENT_IMPACTS) else None,
+                              lemma_path=INGREDIENT_LEMMAS if os.path.exists(INGREDIENT_LEMMAS) else None,
+                              content_stats_path=CONTENT_STATS,
+                              max_workers=SEARCH_WORKERS,
+                              ingredient_timeout=INGREDIENT_TIMEOUT,
+                              keyword_timeout=KEYWORD_TIMEOUT,
+                              attributes_path=ATTRIBUTES,
+                              doc_table_path=DOC_TABLE,
+                              cursor_ttl=CURSOR_TTL,
+                              cursor_key=CURSOR_KEY)
+search_pool = SearchPool(REQUEST_WORKERS, REQUEST_QUEUE, RETRY_AFTER)
+# The engine reads the indexes and derived files once, at startup, so the results are cached under the version it
+# loaded. Rebuilding them needs a restart of the API (/cache/stats reports restart_needed once the files on disk
+# changed), which also starts with an empty cache
+result_cache = ResultCache(RESULT_CACHE_ENTRIES, RESULT_CACHE_BYTES, RESULT_CACHE_TTL, engine.index_version)
+# /search/ as the client sees it: result cache hits included, the time spent waiting for search_pool excluded
+REQUEST_SECONDS = REGISTRY.histogram('recipe_api_search_seconds', 'Duration of a /search/ request on a worker')
 
+@app.exception_handler(PoolFullError)
+async def pool_full(request: Request, exc: PoolFullError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+# the cursor was not issued by this API (or with another RECIPE_SEARCH_CURSOR_KEY)
+@app.exception_handler(InvalidCursorError)
+async def invalid_cursor(request: Request, exc: InvalidCursorError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+# the attribute columns facets are counted on were not built (or are stale), see scripts/build_attribute_columns.py
+@app.exception_handler(FacetsUnavailableError)
+async def facets_unavailable(request: Request, exc: FacetsUnavailableError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+# The searches block for their whole duration, they run on search_pool so the event loop keeps serving
 @app.post("/search/")
-async def search(req: Search):
-    
-    return {"results": [x for x in engine.search(ingredients_str=req.ingredients,
-                                        keywords_str=req.keywords, k=10, ranking=req.type,
-                                        return_full_recipes=req.include_full_recipes,
-                                        cooking_range=req.time_range,
-                                        serving_size_range=req.serving_size_range,
-                                        calories_range=req.calories_range)]}
\ No newline at end of file
+async def search(req: Search, x_profile: str | None = Header(default=None)):
+    if ALLOW_PROFILING and (req.profile or is_enabled(x_profile)):
+        return await search_pool.run(run_profiled_search, req)
+    return await search_pool.run(run_search, req)
+
+# The query is searched in its canonical form ("Garlic, chicken" and "chicken, garlic" are the same search), which
+# is also the key of the result cache
+def run_search(req: Search, k=10):
+    with REQUEST_SECONDS.time():
+        return _run_search(req, k)
+
+def _run_search(req: Search, k=10, use_cache=True):
+    if req.page_size is not None or req.cursor is not None:
+        return run_search_page(req)
+    key = search_key(req, k)
+    ingredients, keywords = key[1], key[2]
+    body = result_cache.get(key) if use_cache else None
+    if body is None:
+        results = engine.search(ingredients_str=ingredients,
+                                keywords_str=keywords, k=k, nsyms=req.nsyms, ranking=req.type,
+                                return_full_recipes=req.include_full_recipes,
+                                cooking_range=req.time_range,
+                                serving_size_range=req.serving_size_range,
+                                calories_range=req.calories_range,
+                                fields=req.fields,
+                                raw_recipes=True)
+        # the recipes are already JSON, they are copied into the body instead of being decoded and encoded again
+        body = encode_results(results)
+        result_cache.put(key, body)
+    return Response(content=body, media_type="application/json")
+
+# A profiled search always searches, a profile of a result cache hit would be empty
+def run_profiled_search(req: Search, k=10):
+    with SamplingProfiler() as profiler:
+        response = _run_search(req, k, use_cache=False)
+    path = profiler.save(profile_path(PROFILE_DIR))
+    prune_profiles(PROFILE_DIR, MAX_PROFILES)
+    # the file name only, not where the server keeps it
+    response.headers['X-Profile'] = os.path.basename(path)
+    return response
+
+def search_key(req: Search, k):
+    ranges = tuple(tuple(r) if r is not None else None
+                   for r in (req.time_range, req.serving_size_range, req.calories_range))
+    return (engine.index_version, canonical_ingredients(req.ingredients), canonical_keywords(req.keywords or ""),
+            req.type or DEFAULT_STRATEGY, k, req.nsyms, ranges, req.include_full_recipes,
+            tuple(req.fields) if req.fields is not None else None)
+
+# Several searches in one request, e.g. the carousels of a page. Answers {"searches": [{"results": ...}, ...]},
+# one entry per search in the order they were sent, each the same as /search/ would answer (pagination is not
+# supported here). Searches found in the result cache are not searched again, the others run as one
+# engine.search_batch, which shares synonyms, postings and recipe hydration between them
+@app.post("/search/batch")
+async def search_batch(reqs: list[Search]):
+    if len(reqs) > MAX_BATCH_SEARCHES:
+        return JSONResponse(status_code=422,
+                            content={"detail": f"At most {MAX_BATCH_SEARCHES} searches per batch, got {len(reqs)}"})
+    return await search_pool.run(run_search_batch, reqs)
+
+def run_search_batch(reqs: list[Search], k=10):
+    keys = [search_key(req, k) for req in reqs]
+    bodies = [result_cache.get(key) for key in keys]
+    missing = [i for i, body in enumerate(bodies) if body is None]
+    if missing:
+        results = engine.search_batch([dict(ingredients_str=keys[i][1], keywords_str=keys[i][2], ranking=reqs[i].type,
+                                            nsyms=reqs[i].nsyms,
+                                            return_full_recipes=reqs[i].include_full_recipes,
+                                            cooking_range=reqs[i].time_range,
+                                            serving_size_range=reqs[i].serving_size_range,
+                                            calories_range=reqs[i].calories_range,
+                                            fields=reqs[i].fields) for i in missing],
+                                      k=k, raw_recipes=True)
+        for i, result in zip(missing, results):
+            bodies[i] = encode_results(result)
+            result_cache.put(keys[i], bodies[i])
+    return Response(content=b'{"searches":[' + b','.join(bodies) + b']}', media_type="application/json")
+
+# Pages are not kept in the result cache, only the ranking behind them is cached (by the engine, CURSOR_TTL seconds
+# after its last page). The next page of a ranking that is gone is ranked again
+def run_search_page(req: Search):
+    page_size = min(max(req.page_size or 10, 1), MAX_PAGE_SIZE)
+    results, next_cursor = engine.search_page(ingredients_str=canonical_ingredients(req.ingredients),
+                                              keywords_str=canonical_keywords(req.keywords or ""),
+                                              page_size=page_size, cursor=req.cursor,
+                                              max_results=MAX_PAGINATED_RESULTS, nsyms=req.nsyms, ranking=req.type,
+                                              return_full_recipes=req.include_full_recipes,
+                                              cooking_range=req.time_range,
+                                              serving_size_range=req.serving_size_range,
+                                              calories_range=req.calories_range,
+                                              fields=req.fields,
+                                              raw_recipes=True)
+    return Response(content=encode_results(results, {"next_cursor": next_cursor}), media_type="application/json")
+
+# All k results of a search as newline-delimited JSON, one [id, score, recipe] array per line, for exports of
+# thousands of full recipes. The ranking and then the hydration run on search_pool, the hydration keeps its place
+# in the pool until the whole response is written. Recipes are hydrated and written STREAM_CHUNK at a time, so
+# memory does not grow with k
+@app.post("/search/stream")
+async def search_stream(req: Search):
+    k = min(max(req.k or STREAM_RESULTS, 1), MAX_STREAM_RESULTS)
+    docids, scores, ranges = await search_pool.run(engine.rank,
+                                                   ingredients_str=canonical_ingredients(req.ingredients),
+                                                   keywords_str=canonical_keywords(req.keywords or ""),
+                                                   k=k, nsyms=req.nsyms,
+                                                   ranking=req.type,
+                                                   cooking_range=req.time_range,
+                                                   serving_size_range=req.serving_size_range,
+                                                   calories_range=req.calories_range)
+    return StreamingResponse(search_pool.stream(ndjson_chunks, req, docids, scores, ranges),
+                             media_type="application/x-ndjson")
+
+def ndjson_chunks(req: Search, docids, scores, ranges):
+    batch = []
+    for result in engine.iter_results(docids, scores, ranges, req.include_full_recipes, req.fields,
+                                      raw_recipes=True, chunk_size=STREAM_CHUNK):
+        batch.append(encode_result(result) + b'\n')
+        if len(batch) == STREAM_CHUNK:
+            yield b''.join(batch)
+            batch = []
+    if batch:
+        yield b''.join(batch)
+
+# Number of matching recipes per time / calories / servings bucket and the most frequent categories and keywords,
+# counted over everything that matches the query and the ranges, not only the returned results. The query is
+# canonicalized like the one of /search/, so both count the same documents for the same query
+@app.post("/facets/")
+async def facets(req: Search):
+    return {"facets": await search_pool.run(engine.facets,
+                                            ingredients_str=canonical_ingredients(req.ingredients),
+                                            keywords_str=canonical_keywords(req.keywords or ""),
+                                            nsyms=req.nsyms,
+                                            cooking_range=req.time_range,
+                                            serving_size_range=req.serving_size_range,
+                                            calories_range=req.calories_range)}
+
+# hits, misses, evictions and size of the result cache
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**result_cache.stats(), 'restart_needed': engine.current_index_version() != engine.index_version}
+
+# Per-stage search latency histograms and work counters (metrics.py) in the Prometheus text format
+@app.get("/metrics")
+async def metrics():
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+# Answered on the event loop, also while every search worker is busy. queued is the current queue depth
+@app.get("/health/")
+async def health():
+    return {"status": "ok", "search_pool": search_pool.stats()}
\ No newline at end of file
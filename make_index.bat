@@ -39,6 +39,42 @@ echo.
 
 python scripts\generate_index_statistics.py
 
+echo.
+echo Exporting BM25 impacts for the ingredient index...
+echo.
+
+python scripts\build_impact_index.py
+
+echo.
+echo Building the ingredient lemma table...
+echo.
+
+python scripts\build_lemma_table.py
+
+echo.
+echo Converting the synonyms...
+echo.
+
+python scripts\build_synonym_store.py
+
+echo.
+echo Parsing the recipe attributes used by the filters...
+echo.
+
+python scripts\build_attribute_columns.py
+
+echo.
+echo Writing the shared document tables...
+echo.
+
+python scripts\build_doc_table.py
+
+echo.
+echo Copying the recipes into the recipe store...
+echo.
+
+python scripts\migrate_recipe_store.py
+
 echo.
 echo All done!
 pause
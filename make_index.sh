@@ -21,5 +21,11 @@ python -m pyserini.index.lucene \
   --pretokenized 
   
 python scripts/generate_index_statistics.py
+python scripts/build_impact_index.py
+python scripts/build_lemma_table.py
+python scripts/build_synonym_store.py
+python scripts/build_attribute_columns.py
+python scripts/build_doc_table.py
+python scripts/migrate_recipe_store.py
 
 #sleep(100)
\ No newline at end of file
@@ -0,0 +1,144 @@
+import bisect
+import threading
+import time
+
+# Always-on search instrumentation: per-stage latency histograms and work counters, kept in memory and rendered in
+# the Prometheus text format (GET /metrics of main.py). Recording a value is a perf_counter call, a bisect and a
+# short locked update, negligible next to the stages it measures. Every process has its own registry, with several
+# API workers (serve.py) a scrape sees the worker that answered it
+
+# upper bounds (seconds) of the latency buckets, from sub-millisecond lookups to multi-second searches
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(label_name, label, extra=""):
+    parts = [f'{label_name}="{label}"'] if label_name is not None else []
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter, optionally split by the value of one label"""
+
+    def __init__(self, name, help, label_name=None):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, label=None):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def value(self, label=None):
+        with self._lock:
+            return self._values.get(label, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label, value in self._values.items():
+                lines.append(f"{self.name}{_labels(self.label_name, label)} {_number(value)}")
+        return lines
+
+class Histogram:
+    """Cumulative histogram (count per bucket, sum, count), optionally split by the value of one label"""
+
+    def __init__(self, name, help, label_name=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        # label -> [count per bucket (the last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label=None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, label=None):
+        """Context manager observing the seconds spent inside of it"""
+        return Timer(self, label)
+
+    def snapshot(self, label=None):
+        """(count per bucket, sum, count) observed under `label`"""
+        with self._lock:
+            counts, total, count = self._series.get(label, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            return list(counts), total, count
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label, list(counts), total, count) for label, (counts, total, count) in self._series.items()]
+        for label, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_name, label, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_name, label)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_name, label)} {count}")
+        return lines
+
+class Timer:
+    __slots__ = ('histogram', 'label', 'start')
+
+    def __init__(self, histogram, label=None):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.label)
+        return False
+
+class Registry:
+    """The metrics of a process, rendered together by render()"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, label_name=None):
+        metric = Counter(name, help, label_name)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label_name=None, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, label_name, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+REGISTRY = Registry()
+
+# The stages of a search: synonyms, ingredient_postings, bm25 (ingredient side), analyze, keyword_postings,
+# dirichlet (keyword side), fusion and hydration. The two sides run in parallel, so the stages of a search can add
+# up to more than its duration
+SEARCH_SECONDS = REGISTRY.histogram('recipe_search_seconds', 'Duration of CustomRecipeSearcher.search')
+STAGE_SECONDS = REGISTRY.histogram('recipe_search_stage_seconds', 'Duration of one stage of a search', 'stage')
+POSTINGS_TOUCHED = REGISTRY.counter('recipe_search_postings_touched_total',
+                                    'Postings read and scored (MaxScore skips are not counted)', 'side')
+POSTINGS_SKIPPED = REGISTRY.counter('recipe_search_postings_skipped_total',
+                                    'Postings of the query terms that MaxScore pruning never scored', 'side')
+CANDIDATES_SCORED = REGISTRY.counter('recipe_search_candidates_scored_total',
+                                     'Documents that received a score before the top k was selected', 'side')
+
+def stage(name):
+    """with stage('bm25'): ... adds the time spent inside to STAGE_SECONDS"""
+    return Timer(STAGE_SECONDS, name)
@@ -0,0 +1,122 @@
+import collections
+import os
+import queue
+import sys
+import threading
+import time
+import concurrent.futures.thread
+
+# Opt-in profiling of single searches: a sampling profiler whose output is in the collapsed stack format
+# ("frame;frame;frame count" per line) that flamegraph.pl, speedscope and inferno read. Nothing here runs unless a
+# search is profiled, the searches that are not pay nothing
+
+# a pool thread whose whole stack is in these files is waiting for work, its samples are left out
+IDLE_FILES = {threading.__file__, queue.__file__, concurrent.futures.thread.__file__}
+
+def frame_name(code):
+    # ';' separates the frames of a collapsed stack
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+class SamplingProfiler:
+    """Samples, every `interval` seconds, the Python stack of the thread that started it and of the threads whose
+    name starts with one of `thread_prefixes` (by default the ingredient / keyword branch workers of
+    CustomRecipeSearcher). The samples are taken by a background thread, the profiled code is not changed or
+    slowed down besides the GIL it briefly holds. Time spent in native code (the JVM, numpy, SQLite) is counted
+    on the Python frame that called it. Branch workers are shared between searches: a search running next to the
+    profiled one can show up in their samples."""
+
+    def __init__(self, interval=0.001, thread_prefixes=('recipe-search',)):
+        self.interval = interval
+        self.thread_prefixes = tuple(thread_prefixes)
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._start = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._start
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def _threads(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        threads = {self._target: 'request'}
+        for ident, name in names.items():
+            if name.startswith(self.thread_prefixes):
+                threads[ident] = name
+        return threads
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            threads = self._threads()
+            for ident, frame in sys._current_frames().items():
+                name = threads.get(ident)
+                if name is None:
+                    continue
+                stack = []
+                idle = True
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    idle = idle and frame.f_code.co_filename in IDLE_FILES
+                    frame = frame.f_back
+                if idle and ident != self._target:
+                    continue
+                stack.append(name)
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """The samples as collapsed stacks, one "thread;outermost frame;...;innermost frame count" line per stack"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def save(self, path):
+        """Writes collapsed() to `path` (directories are created) and returns the path"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+        return path
+
+def is_enabled(value):
+    """A flag from an environment variable or a header: "1", "true", "yes" and "on" (any case) turn it on"""
+    return value is not None and value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def prune_profiles(directory, keep):
+    """Deletes the oldest .collapsed files of `directory` until at most `keep` are left"""
+    profiles = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.collapsed'):
+            try:
+                profiles.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                # removed by a concurrent prune
+                pass
+    profiles.sort()
+    for _, path in profiles[:max(0, len(profiles) - keep)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def profile_path(directory, name='search'):
+    """A new file name in `directory` for a profile, e.g. profiles/search-20250101-120000-1a2b3c.collapsed"""
+    return os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}.collapsed")
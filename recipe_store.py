@@ -0,0 +1,172 @@
+import json
+import queue
+import sqlite3
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Read side of the SQLite copy of the recipe shelf written by scripts/migrate_recipe_store.py.
+# One row per recipe: the recipe id (canonical url) and the recipe dict encoded as JSON.
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+def is_recipe_store(path):
+    """True if `path` is a SQLite recipe store and not a shelve database"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+def json_path(field):
+    """JSON path of a top level recipe key, quoted so dots and spaces are taken literally"""
+    # SQLite has no escape for a quote inside a quoted path label
+    if '"' in field:
+        raise ValueError(f"Invalid recipe field {field!r}")
+    return f'$."{field}"'
+
+def project(recipe, fields):
+    """The `fields` of a recipe dict (None for a missing key), what RecipeStore.get_many returns for them"""
+    if recipe is None or fields is None:
+        return recipe
+    return {field: recipe.get(field) for field in fields}
+
+def dumps(value):
+    """Compact UTF-8 JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def encode_result(item):
+    """One (id, score[, raw recipe]) search result as a JSON array, the recipe bytes are copied in as they are"""
+    head = dumps([item[0], item[1]])
+    if len(item) > 2:
+        head = head[:-1] + b',' + (item[2] if item[2] is not None else b'null') + b']'
+    return head
+
+def encode_results(results, extra=None):
+    """
+    Body of a search response, {"results": [[id, score, recipe], ...]}, for search results hydrated with
+    raw recipes (bytes from get_many_raw, or None). Only the ids and scores are encoded, the recipe JSON is
+    copied into the body as it was stored. The keys of `extra` (e.g. next_cursor) are added after "results".
+    """
+    items = [encode_result(item) for item in results]
+    tail = b''.join(b',' + dumps(key) + b':' + dumps(value) for key, value in extra.items()) if extra else b''
+    return b'{"results":[' + b','.join(items) + b']' + tail + b'}'
+
+class RecipeStore:
+    """Recipes by id from a read-only SQLite store. Opened once per process and shared by every request: each
+    lookup borrows a connection from a small pool (at most `pool_size`, opened when first needed), so concurrent
+    requests read in parallel without sharing a connection. get_many fetches a whole result list with a few
+    `IN (...)` queries instead of one lookup per recipe."""
+
+    def __init__(self, store_path, pool_size=8, chunk_size=500):
+        self.store_path = store_path
+        self.pool_size = pool_size
+        # ids per query, below SQLITE_MAX_VARIABLE_NUMBER of old SQLite builds (999)
+        self.chunk_size = chunk_size
+        self._pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+        # fail here and not in the middle of the first request if the store is missing
+        self._release(self._acquire())
+
+    def _connect(self):
+        # The store is never written while serving: read-only connections only take shared locks, so readers
+        # never wait for each other (and, unlike WAL, nothing has to be writable next to the file)
+        connection = sqlite3.connect(f'file:{self.store_path}?mode=ro', uri=True, check_same_thread=False)
+        connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"Recipe store {self.store_path} is closed")
+            if self._opened < self.pool_size:
+                self._opened += 1
+                opening = True
+            else:
+                opening = False
+        if opening:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        # every connection is in use, wait for one to come back
+        return self._pool.get()
+
+    def _release(self, connection):
+        with self._lock:
+            if self._closed:
+                connection.close()
+                return
+        self._pool.put(connection)
+
+    def _rows(self, sql, ids, params=()):
+        """Runs `sql` (with a `{ids}` placeholder list, after `params`) over `ids` in chunks, returns {id: data}"""
+        rows = {}
+        connection = self._acquire()
+        try:
+            for start in range(0, len(ids), self.chunk_size):
+                chunk = ids[start:start + self.chunk_size]
+                query = sql.format(ids=','.join('?' * len(chunk)))
+                rows.update(connection.execute(query, [*params, *chunk]).fetchall())
+        finally:
+            self._release(connection)
+        return rows
+
+    def _select(self, recipe_ids, fields, raw):
+        """{id: JSON of the recipe or of its `fields`} of the ids found, as bytes when `raw`"""
+        unique_ids = list(dict.fromkeys(recipe_ids))
+        if fields is None:
+            column, params = 'data', []
+        else:
+            # the object is built by SQLite, the rest of the recipe (instructions, ingredient lists) never
+            # leaves the database
+            fields = list(dict.fromkeys(fields))
+            column = f"json_object({', '.join(['?, json_extract(data, ?)'] * len(fields))})"
+            params = [param for field in fields for param in (field, json_path(field))]
+        if raw:
+            column = f'CAST({column} AS BLOB)'
+        return self._rows(f'SELECT id, {column} FROM recipes WHERE id IN ({{ids}})', unique_ids, params)
+
+    def get_many(self, recipe_ids, fields=None):
+        """Recipe dicts of `recipe_ids`, in the same order, None for an id that is not in the store.
+        With `fields` only those keys are returned (None for a key the recipe does not have)"""
+        recipes = {recipe_id: json.loads(data) for recipe_id, data in self._select(recipe_ids, fields, False).items()}
+        return [recipes.get(recipe_id) for recipe_id in recipe_ids]
+
+    def get_many_raw(self, recipe_ids, fields=None):
+        """Same as get_many, but every recipe is the UTF-8 JSON stored for it, as bytes, to be copied into a
+        response as is (see encode_results)"""
+        recipes = self._select(recipe_ids, fields, True)
+        return [recipes.get(recipe_id) for recipe_id in recipe_ids]
+
+    def get_recipe(self, recipe_id, fields=None):
+        return self.get_many([recipe_id], fields)[0]
+
+    def __len__(self):
+        connection = self._acquire()
+        try:
+            return connection.execute('SELECT COUNT(*) FROM recipes').fetchone()[0]
+        finally:
+            self._release(connection)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
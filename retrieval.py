@@ -3,29 +3,56 @@ from re import S
 import numpy as np
 from pyserini.index import LuceneIndexReader
 from pyserini.search.lucene import LuceneSearcher
+import base64
 import bisect # https://docs.python.org/3/library/bisect.html
+import hashlib
+import hmac
 import json
-import math
-from collections import defaultdict
+import os
+import secrets
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import defaultdict, OrderedDict
 from scipy.sparse import csr_matrix
-import spacy
 
-from scripts.generating_synonyms import SYNONYMS_OUTPUT_PATH
+from scripts.generate_index_statistics import index_version, compute_content_stats
+from scripts.build_attribute_columns import global_doc_ids, doc_ids_fingerprint, parse_number
 import shelve
 from tqdm import tqdm
 from pprint import pprint
 import argparse
 
+from caching import PostingsCache, ResultCache, postings_to_arrays
+from recipe_store import RecipeStore, is_recipe_store, project, dumps
+import fusion
+from fusion import top_k_indices
+from profiling import SamplingProfiler
+from metrics import (stage, SEARCH_SECONDS, STAGE_SECONDS, POSTINGS_TOUCHED, POSTINGS_SKIPPED,
+                     CANDIDATES_SCORED)
+
 
 CONTENT_INDEX = 'indexes/content'
 INGREDIENT_INDEX = 'indexes/ingredients_pretokenized'
 INGREDIENT_STATS = 'indexes/stats/ingredients_pretokenized.json'
+CONTENT_STATS = 'indexes/stats/content'
+INGREDIENT_IMPACTS = 'indexes/impacts/ingredients_pretokenized'
+INGREDIENT_LEMMAS = 'indexes/stats/ingredient_lemmas.json'
 INGREDIENT_SYNONYMS = 'files/other/synonyms.json'
+INGREDIENT_SYNONYMS_STORE = 'files/other/synonyms_store'
+ATTRIBUTES = 'indexes/attributes'
+DOC_TABLE = 'indexes/doc_table'
 RECIPE_SHELVES_PATH = 'files/foodrecipes_shelves/foodrecipes_shelves.db'
+RECIPE_STORE_PATH = 'files/foodrecipes_store/foodrecipes.sqlite'
 
+# Recipes straight from the shelf written by scripts/index.py, used when the recipe store
+# (scripts/migrate_recipe_store.py) was not built. The shelf is opened for every lookup and shelve can't be
+# read from several threads, so lookups are serialised
 class RecipeInfoRetrieval:
     def __init__(self, recipe_path):
         self.recipe_path = recipe_path
+        self._lock = threading.Lock()
         
     def open(self):
         self.shelf = shelve.open(self.recipe_path)
@@ -37,19 +64,97 @@ class RecipeInfoRetrieval:
     
     def close(self):
         self.shelf.close()
+    
+    # Same as RecipeStore.get_many, the shelf has to unpickle the whole recipe to project it
+    def get_many(self, recipe_ids, fields=None):
+        with self._lock:
+            self.open()
+            try:
+                return [project(self.get_recipe(recipe_id), fields) for recipe_id in recipe_ids]
+            finally:
+                self.close()
+    
+    # Same as RecipeStore.get_many_raw, the shelf has no JSON to hand out so the recipes are encoded here
+    def get_many_raw(self, recipe_ids, fields=None):
+        return [dumps(recipe) if recipe is not None else None for recipe in self.get_many(recipe_ids, fields)]
+
+class IngredientNormalizer:
+    """Turns a surface ingredient ("chicken breasts") into the underscore term stored in the index ("chicken_breast").
+    Strings known at index time come from the table written by `scripts/build_lemma_table.py`. Anything else
+    runs through spaCy, which is only loaded the first time it is needed, and the result is kept in a bounded
+    LRU cache"""
+    
+    def __init__(self, lemma_path=None, cache_size=10000):
+        self.table = {}
+        if lemma_path is not None:
+            with open(lemma_path, 'r', encoding='utf-8') as f:
+                self.table = json.load(f)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # _lock guards the LRU cache and the counters only, it is never held while spaCy runs. _spacy_lock
+        # serializes loading and running spaCy, so an unknown ingredient only makes other unknown ones wait
+        self._lock = threading.Lock()
+        self._spacy_lock = threading.Lock()
+        self.nlp = None
+        self.table_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+    
+    def _spacy_normalize(self, ingredient):
+        with self._spacy_lock:
+            if self.nlp is None:
+                import spacy
+                self.nlp = spacy.load("en_core_web_sm")
+            doc = self.nlp(ingredient)
+        ingredient = [token.lemma_.lower() for token in doc if not token.is_stop and not token.is_punct]
+        return "_".join(ingredient)
+    
+    # Table and cache are keyed on the stripped, lowercased string, the form the table was built from (spaCy
+    # lowercases the lemmas anyway), so "Chicken Breast " is a table hit like "chicken breast".
+    # spaCy runs outside of _lock: concurrent misses on the same string may both run it, the result is the same
+    def normalize(self, ingredient):
+        key = ingredient.strip().lower()
+        term = self.table.get(key)
+        with self._lock:
+            if term is not None:
+                self.table_hits += 1
+                return term
+            term = self._cache.get(key)
+            if term is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return term
+            self.misses += 1
+        term = self._spacy_normalize(key)
+        with self._lock:
+            self._cache[key] = term
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return term
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.table_hits + self.cache_hits + self.misses
+            return {
+                'table_hits': self.table_hits,
+                'cache_hits': self.cache_hits,
+                'misses': self.misses,
+                'hit_rate': (self.table_hits + self.cache_hits) / lookups if lookups else 0.0,
+                'cache_entries': len(self._cache),
+            }
 
 class LuceneCustomRecipeReader(LuceneIndexReader):
     """Custom Lucene index reader for recipe search. The only addition is that every time the required
     methods are called, we are going to first process the recipe into the undercores, bacuse by default the 
     Anserini is not supporting full phrase indexing """
     
-    def __init__(self, index_path):
+    def __init__(self, index_path, normalizer=None):
         super().__init__(index_path)
-        self.nlp = spacy.load("en_core_web_sm")
+        self.normalizer = normalizer if normalizer is not None else IngredientNormalizer()
     
     def _preprocess_ingredient(self, ingredient):
-        ingredient = [token.lemma_.lower() for token in self.nlp(ingredient) if not token.is_stop and not token.is_punct]
-        return "_".join(ingredient)
+        return self.normalizer.normalize(ingredient)
     
     #@override
     def get_postings_list(self, term, analyzer=None):
@@ -61,21 +166,341 @@ class LuceneCustomRecipeReader(LuceneIndexReader):
         term = self._preprocess_ingredient(term)
         return super().get_term_counts(term, analyzer)
     
+class ImpactIndexReader:
+    """Memory-mapped BM25 impact index exported by `scripts/build_impact_index.py`. Postings of a term are
+    numpy views into the mapped files, so scoring never has to go through Lucene. Impacts hold only the
+    term frequency part of BM25, the idf is applied at query time"""
+    
+    def __init__(self, impacts_path):
+        with open(os.path.join(impacts_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(impacts_path, 'terms.json'), 'r', encoding='utf-8') as f:
+            self.term_ids = {term: j for j, term in enumerate(json.load(f))}
+        self.indptr = np.load(os.path.join(impacts_path, 'indptr.npy'), mmap_mode='r')
+        self.docids = np.load(os.path.join(impacts_path, 'docids.npy'), mmap_mode='r')
+        self.impacts = np.load(os.path.join(impacts_path, 'impacts.npy'), mmap_mode='r')
+        self.max_impacts = np.load(os.path.join(impacts_path, 'max_impacts.npy'), mmap_mode='r')
+        self.num_docs = self.meta['num_docs']
+
+    def matches(self, index_path, num_docs):
+        """Whether the impacts were exported from the index as it is on disk (index files without a version are
+        from before it was recorded and never match)"""
+        return (self.meta.get('index_version') == index_version(index_path)
+                and self.num_docs == num_docs)
+        
+    def postings(self, term):
+        """(docids, impacts, max impact) of an already normalised index term, empty arrays if the term is unknown"""
+        j = self.term_ids.get(term)
+        if j is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32), 0.0
+        start, end = self.indptr[j], self.indptr[j + 1]
+        return self.docids[start:end], self.impacts[start:end], float(self.max_impacts[j])
+    
+class SynonymStore:
+    """Read-only synonym dictionary written by `scripts/build_synonym_store.py`. The arrays are memory mapped,
+    so every worker process shares the same pages, and a lookup only decodes the synonyms it returns.
+    Entries are (term, score, sim) triples like in synonyms.json"""
+    
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, 'terms.json'), 'r', encoding='utf-8') as f:
+            self.terms = json.load(f)
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        self.indptr = np.load(os.path.join(store_path, 'indptr.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(store_path, 'targets.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(store_path, 'scores.npy'), mmap_mode='r')
+        self.sims = np.load(os.path.join(store_path, 'sims.npy'), mmap_mode='r')
+    
+    def __contains__(self, ingredient):
+        i = self.term_ids.get(ingredient)
+        return i is not None and self.indptr[i + 1] > self.indptr[i]
+    
+    def lookup(self, ingredient, n=None):
+        """The first n synonyms of `ingredient`, empty list if it has none"""
+        i = self.term_ids.get(ingredient)
+        if i is None:
+            return []
+        start, end = int(self.indptr[i]), int(self.indptr[i + 1])
+        if n is not None:
+            end = min(end, start + n)
+        return [
+            (self.terms[t], float(score), float(sim))
+            for t, score, sim in zip(self.targets[start:end].tolist(), self.scores[start:end].tolist(),
+                                     self.sims[start:end].tolist())
+        ]
+    
+    def __getitem__(self, ingredient):
+        if ingredient not in self.term_ids:
+            raise KeyError(ingredient)
+        return self.lookup(ingredient)
+    
+class AttributeStore:
+    """Numeric recipe attributes (total_time, calories, yields) written by `scripts/build_attribute_columns.py`,
+    one memory-mapped float column per attribute indexed by global doc id, NaN where the value is unknown.
+    Turns the range filters of a search into a boolean mask over all documents"""
+    
+    def __init__(self, attributes_path):
+        with open(os.path.join(attributes_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.num_docs = self.meta['num_docs']
+        self.columns = {
+            field: np.load(os.path.join(attributes_path, f'{field}.npy'), mmap_mode='r')
+            for field in self.meta['fields']
+        }
+        # facet data, only written by newer versions of the script
+        self.has_facets = 'buckets' in self.meta
+        if self.has_facets:
+            self.buckets = {
+                field: np.load(os.path.join(attributes_path, f'{field}_buckets.npy'), mmap_mode='r')
+                for field in self.meta['buckets']
+            }
+            self.category = np.load(os.path.join(attributes_path, 'category.npy'), mmap_mode='r')
+            self.keywords_indptr = np.load(os.path.join(attributes_path, 'keywords_indptr.npy'), mmap_mode='r')
+            self.keywords_codes = np.load(os.path.join(attributes_path, 'keywords_codes.npy'), mmap_mode='r')
+            with open(os.path.join(attributes_path, 'categories.json'), 'r', encoding='utf-8') as f:
+                self.category_names = json.load(f)
+            with open(os.path.join(attributes_path, 'keywords.json'), 'r', encoding='utf-8') as f:
+                self.keyword_names = json.load(f)
+    
+    def matches(self, doc_ids, fingerprint=None):
+        """Whether the columns were built for exactly this list of external ids (fingerprint: its
+        doc_ids_fingerprint, when already known)"""
+        if len(doc_ids) != self.num_docs:
+            return False
+        return (fingerprint if fingerprint is not None else doc_ids_fingerprint(doc_ids)) == self.meta['doc_ids']
+    
+    def mask(self, ranges):
+        """Documents whose attributes are all inside the given {field: (min, max)} ranges, bounds included.
+        Unknown values never match, like in the filter applied to the hydrated recipes"""
+        mask = np.ones(self.num_docs, dtype=bool)
+        for field, (low, high) in ranges.items():
+            column = self.columns[field]
+            mask &= (column >= low) & (column <= high)
+        return mask
+    
+    @staticmethod
+    def bucket_labels(edges):
+        edges = [f"{edge:g}" for edge in edges]
+        return [f"<{edges[0]}"] + [f"{low}-{high}" for low, high in zip(edges, edges[1:])] + [f"{edges[-1]}+", "unknown"]
+    
+    def facet_counts(self, docids, top_n=20):
+        """Facet counts over the documents `docids` (global ids, no duplicates). Numeric fields give the count of
+        every bucket ("15-30" is 15 <= value < 30), category and keywords the top_n most frequent values"""
+        facets = {}
+        for field, edges in self.meta['buckets'].items():
+            counts = np.bincount(self.buckets[field][docids], minlength=len(edges) + 2)
+            facets[field] = dict(zip(self.bucket_labels(edges), counts.tolist()))
+        
+        categories = self.category[docids]
+        counts = np.bincount(categories[categories >= 0], minlength=len(self.category_names))
+        facets['category'] = self._top_values(counts, self.category_names, top_n)
+        
+        # gather the keyword codes of all documents at once from the CSR rows
+        starts = self.keywords_indptr[docids]
+        lengths = self.keywords_indptr[np.asarray(docids) + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        codes = self.keywords_codes[offsets + np.arange(int(lengths.sum()))]
+        counts = np.bincount(codes, minlength=len(self.keyword_names))
+        facets['keywords'] = self._top_values(counts, self.keyword_names, top_n)
+        return facets
+    
+    @staticmethod
+    def _top_values(counts, names, top_n):
+        order = top_k_indices(counts, min(top_n, int(np.count_nonzero(counts))))
+        return {names[i]: int(counts[i]) for i in order}
+    
+class StringTable:
+    """Read-only list of strings stored back to back in one memory-mapped UTF-8 array (written by
+    scripts/build_doc_table.py), string i is decoded when it is asked for"""
+    
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def prefix(self, n):
+        """The first n strings, without copying"""
+        return StringTable(self.data, self.offsets[:n + 1])
+
+class DocTable:
+    """Per document tables of both indexes written by scripts/build_doc_table.py: the external ids, the global doc
+    id space and the ingredient document lengths. Everything is memory mapped, so the worker processes of the API
+    share one copy in the page cache instead of each building its own lists"""
+    
+    def __init__(self, doc_table_path):
+        with open(os.path.join(doc_table_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        load = lambda name: np.load(os.path.join(doc_table_path, f'{name}.npy'), mmap_mode='r')
+        self.doc_ids = StringTable(load('doc_ids'), load('doc_ids_offsets'))
+        self.ingredient_ids = self.doc_ids.prefix(self.meta['num_ingredient_docs'])
+        self.content_ids = StringTable(load('content_ids'), load('content_ids_offsets'))
+        self.content_to_global = load('content_to_global')
+        self.ingredient_dl = load('ingredient_dl')
+    
+    def matches(self, ingredient_path, content_path):
+        """Whether the table was built from the indexes as they are on disk"""
+        return (self.meta['ingredient_index_version'] == index_version(ingredient_path)
+                and self.meta['content_index_version'] == index_version(content_path))
+
 class IngredientSearcher:
-    def __init__(self, ingredient_path, index_stats_path, synonym_path = None):
+    def __init__(self, ingredient_path, index_stats_path, synonym_path = None, impact_path = None, lemma_path = None,
+                 postings_cache = None, doc_table = None):
         
-        self.ingredient_reader = LuceneCustomRecipeReader(ingredient_path)
+        self.postings_cache = postings_cache
+        self.normalizer = IngredientNormalizer(lemma_path)
+        self.ingredient_reader = LuceneCustomRecipeReader(ingredient_path, self.normalizer)
         self.ingredient_searcher = LuceneSearcher(ingredient_path)
-        with open(index_stats_path, 'r') as f:
-            self.stats = json.load(f)
+        # the ids and document lengths come from the shared DocTable when there is one
+        if doc_table is not None:
+            self.stats = {'iids': doc_table.ingredient_ids, 'avgdl': doc_table.meta['ingredient_avgdl']}
+            self.dl = doc_table.ingredient_dl
+        else:
+            with open(index_stats_path, 'r') as f:
+                self.stats = json.load(f)
+            self.dl = np.array(self.stats.pop('dl'), dtype=float)
         
-        if synonym_path is not None:
+        # synonym_path is either the converted store directory or the original synonyms.json
+        if synonym_path is not None and os.path.isdir(synonym_path):
+            self.synonyms = SynonymStore(synonym_path)
+        elif synonym_path is not None:
             with open(synonym_path, 'r') as f:
                 self.synonyms = json.load(f)    
         else:
             self.synonyms = None
+        
+        # precomputed impacts, when present the query is scored without any Lucene calls. Impacts exported from
+        # another build of the index would give wrong scores and docids, the postings are then read from Lucene
+        self.impact_index = None
+        if impact_path is not None:
+            impact_index = ImpactIndexReader(impact_path)
+            if impact_index.matches(ingredient_path, self.ingredient_searcher.num_docs):
+                self.impact_index = impact_index
+            else:
+                warnings.warn(f"Impact index in {impact_path} does not match the index at {ingredient_path}, "
+                              "reading the postings from Lucene. Run scripts/build_impact_index.py to rebuild it")
+        # postings scored/skipped by the last query of each thread (see last_query_stats)
+        self._local = threading.local()
+
+    # Postings scored/skipped by the last query this thread scored, useful to check how much the pruning saves.
+    # Kept per thread, so concurrent queries on a shared searcher don't overwrite each other's stats. Under
+    # CustomRecipeSearcher the ingredient side is scored on a branch worker, not on the thread that searched
+    @property
+    def last_query_stats(self):
+        return getattr(self._local, 'query_stats', {})
+
+    @last_query_stats.setter
+    def last_query_stats(self, stats):
+        self._local.query_stats = stats
 
-    def search_ingredients(self, ingredients_string, k=1000, nsyms=5):
+    # exhaustive=True scores every posting of every term, otherwise documents that provably
+    # cannot enter the top-k are skipped (MaxScore). Both return the same top-k
+    def search_ingredients(self, ingredients_string, k=1000, nsyms=5, scoring='sparse', exhaustive=False):
+        return self._with_iids(*self.rank_ingredients(ingredients_string, k, nsyms, scoring, exhaustive))
+
+    # Same as search_ingredients but returns the (internal docids, scores) arrays, best first.
+    # doc_mask (boolean, one entry per docid) restricts the ranking to the documents where it is True
+    def rank_ingredients(self, ingredients_string, k=1000, nsyms=5, scoring='sparse', exhaustive=False,
+                         doc_mask=None):
+        with stage('synonyms'):
+            terms, weights = self._expand_query(ingredients_string, nsyms)
+
+        # 4) Now call your BM25, passing in *aligned* terms & weights
+        if scoring == 'sparse' and self.impact_index is not None:
+            return self._impact_search_ingredients(terms, weights, k=k, exhaustive=exhaustive, doc_mask=doc_mask)
+        return self._bm25search_ingredients(
+            ingredients_list=terms,
+            ingredient_weights=weights,
+            reader=self.ingredient_reader,
+            docinfo=self.stats,
+            k=k,
+            mode=scoring,
+            exhaustive=exhaustive,
+            doc_mask=doc_mask
+        )
+
+    # Ranked (docids, scores) arrays -> [(external id, score), ...]
+    def _with_iids(self, docids, scores):
+        iids = self.stats['iids']
+        return [(iids[docid], float(score)) for docid, score in zip(docids.tolist(), scores)]
+
+    # Every document with a positive score, as unranked (docids, scores) arrays in docid order. This is the
+    # input of the threshold algorithm fusion, which decides by itself how deep to read the ranking
+    def score_ingredients(self, ingredients_string, nsyms=5, coverage_alpha = 1, doc_mask=None):
+        with stage('synonyms'):
+            terms, weights = self._expand_query(ingredients_string, nsyms)
+        with stage('ingredient_postings'):
+            if self.impact_index is not None:
+                term_postings = self._impact_term_postings(terms, weights)
+            else:
+                term_postings = self._lucene_term_postings(terms, weights, self.ingredient_reader)
+            term_postings = self._mask_postings(term_postings, doc_mask)
+        total_postings = sum(len(docids) for docids, _, _, _ in term_postings)
+        if total_postings == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+        with stage('bm25'):
+            candidates, scores, matched_counts = self._accumulate(term_postings)
+            coverage = matched_counts / np.sum(weights)
+            adjusted_scores = scores * (1 + coverage_alpha * coverage)
+            positive = adjusted_scores > 0
+        POSTINGS_TOUCHED.inc(total_postings, 'ingredients')
+        CANDIDATES_SCORED.inc(len(candidates), 'ingredients')
+        return candidates[positive], adjusted_scores[positive]
+
+    # The ranking of an ingredient query as a fusion.RankedList, ranked only as deep as the threshold algorithm
+    # fusion reads it: the synonyms and the postings are loaded once, every deeper read runs MaxScore for the new
+    # depth, random access scores the documents asked for from the same postings. Documents with a positive
+    # score only, like score_ingredients
+    def ranked_ingredients(self, ingredients_string, nsyms=5, coverage_alpha = 1, doc_mask=None):
+        with stage('synonyms'):
+            terms, weights = self._expand_query(ingredients_string, nsyms)
+        with stage('ingredient_postings'):
+            if self.impact_index is not None:
+                term_postings = self._impact_term_postings(terms, weights)
+            else:
+                term_postings = self._lucene_term_postings(terms, weights, self.ingredient_reader)
+            term_postings = self._mask_postings(term_postings, doc_mask)
+        def fetch(depth):
+            docids, scores = self._score_candidates(term_postings, weights, self.stats, k=depth,
+                                                    coverage_alpha=coverage_alpha, exhaustive=False)
+            positive = scores > 0
+            return docids[positive], scores[positive]
+        def score(docids):
+            return self._score_documents(term_postings, np.sum(weights), docids, coverage_alpha)
+        return fusion.RankedList(fetch, score)
+
+    # Random access: the scores of the given documents, (found mask, scores), looked up in the postings of every
+    # term with a binary search. A document is found when its score is positive
+    def _score_documents(self, term_postings, weight_sum, docids, coverage_alpha = 1):
+        docids = np.asarray(docids)
+        scores = np.zeros(len(docids))
+        counts = np.zeros(len(docids), dtype=np.int64)
+        scored = 0
+        with stage('bm25'):
+            for term_docids, impacts, factor, _ in term_postings:
+                if len(term_docids) == 0:
+                    continue
+                pos = np.minimum(np.searchsorted(term_docids, docids), len(term_docids) - 1)
+                hit = term_docids[pos] == docids
+                scores[hit] += factor * impacts[pos[hit]]
+                counts[hit] += 1
+                scored += int(hit.sum())
+            adjusted_scores = scores * (1 + coverage_alpha * counts / weight_sum)
+        POSTINGS_TOUCHED.inc(scored, 'ingredients')
+        return adjusted_scores > 0, adjusted_scores
+
+    # Expands a comma separated ingredient query into aligned (terms, weights). `groups_memo` lets a batch
+    # of queries share the synonym expansion of the ingredients they have in common
+    def _expand_query(self, ingredients_string, nsyms, groups_memo = None):
         # 1) Parse the user’s comma‑separated ingredients
         ingredients = [ing.strip() for ing in ingredients_string.split(',')]
         ingredients = list(set(ingredients))  
@@ -83,13 +508,17 @@ class IngredientSearcher:
         # 2) Build one group per original ingredient
         groups = {}
         for ing in ingredients:
+            if groups_memo is not None and ing in groups_memo:
+                groups[ing] = groups_memo[ing]
+                continue
             # start with the ingredient itself at weight=1
             syns = [(ing, 1.0)]
             # add up to nsyms synonyms (term, score)
-            if self.synonyms is not None and ing in self.synonyms:
-                for term, _, score in self.synonyms[ing][:nsyms]:
-                    syns.append((term, float(score)))
+            for term, _, score in self._synonyms_for(ing, nsyms):
+                syns.append((term, float(score)))
             groups[ing] = syns
+            if groups_memo is not None:
+                groups_memo[ing] = syns
 
         # 3) Normalize each group so its weights sum to 1.0
         terms, weights = [], []
@@ -98,21 +527,79 @@ class IngredientSearcher:
             for term, w in syns:
                 terms.append(term)
                 weights.append(w / total if total > 0 else 0.0)
-
-        # 4) Now call your BM25, passing in *aligned* terms & weights
-        return self._bm25search_ingredients(
-            ingredients_list=terms,
-            ingredient_weights=weights,
-            reader=self.ingredient_reader,
-            docinfo=self.stats,
-            k=k
-        )
-            
+        return terms, weights
+    
+    def _synonyms_for(self, ingredient, nsyms):
+        if self.synonyms is None:
+            return []
+        if isinstance(self.synonyms, SynonymStore):
+            return self.synonyms.lookup(ingredient, nsyms)
+        return self.synonyms.get(ingredient, [])[:nsyms]
+    
+    # (docids, tfs) arrays of a query term, served from the shared postings cache when there is one
+    def _postings(self, term, reader = None):
+        if reader is None:
+            reader = self.ingredient_reader
+        load = lambda: postings_to_arrays(reader.get_postings_list(term, analyzer=None))
+        if self.postings_cache is None or reader is not self.ingredient_reader:
+            return load()
+        return self.postings_cache.get(('ingredients', self.normalizer.normalize(term)), load)
+    
+    # (docids, impacts, max impact) of a term read from Lucene, the impact is the tf part of BM25
+    def _lucene_term_impacts(self, term, reader = None, k1=1.5, b=0.75):
+        docids, tf = self._postings(term, reader)
+        numer = tf * (k1 + 1.0)
+        denom = tf + k1 * (1.0 - b + b * (self.dl[docids] / self.stats['avgdl']))
+        impacts = numer / denom
+        return docids, impacts, impacts.max() if len(impacts) else 0.0
+    
+    # BM25 with a coverage boost. mode='sparse' only touches the documents that appear in the postings,
+    # mode='dense' is the original full-corpus implementation. Both give the same scores, the dense one
+    # additionally pads the result with zero-score documents when fewer than k documents match
     def _bm25search_ingredients(self, ingredients_list, ingredient_weights = None, 
                                 reader = None, docinfo = None, 
-                                k=1000, k1=1.5, b=0.75, coverage_alpha = 1):
+                                k=1000, k1=1.5, b=0.75, coverage_alpha = 1, mode='sparse', exhaustive=True,
+                                doc_mask=None):
+        if mode == 'dense':
+            if doc_mask is not None:
+                raise ValueError("doc_mask is only supported by the sparse scoring")
+            with stage('bm25'):
+                return self._dense_bm25search_ingredients(ingredients_list, ingredient_weights, reader, docinfo,
+                                                          k=k, k1=k1, b=b, coverage_alpha=coverage_alpha)
+        if mode != 'sparse':
+            raise ValueError(f"Unknown scoring mode: {mode}")
+        if ingredient_weights is None:
+            ingredient_weights = [1.0] * len(ingredients_list)
+        with stage('ingredient_postings'):
+            term_postings = self._mask_postings(
+                self._lucene_term_postings(ingredients_list, ingredient_weights, reader, k1, b), doc_mask)
+        return self._score_candidates(term_postings, ingredient_weights, docinfo,
+                                      k=k, coverage_alpha=coverage_alpha, exhaustive=exhaustive)
+    
+    # Drops the postings of the documents outside of doc_mask. The idf and the max impacts stay the ones of the
+    # complete lists, the scores don't change and the max impacts are still valid upper bounds for MaxScore
+    def _mask_postings(self, term_postings, doc_mask):
+        if doc_mask is None:
+            return term_postings
+        masked = []
+        for docids, impacts, factor, max_impact in term_postings:
+            keep = doc_mask[docids]
+            masked.append((docids[keep], impacts[keep], factor, max_impact))
+        return masked
+    
+    # (docids, impacts, factor, max impact) of every query term, read from Lucene
+    def _lucene_term_postings(self, ingredients_list, ingredient_weights, reader = None, k1=1.5, b=0.75):
+        N = self.ingredient_searcher.num_docs
+        blocks = [self._lucene_term_impacts(term, reader, k1, b) for term in ingredients_list]
+        df = np.array([len(docids) for docids, _, _ in blocks], dtype=float)
+        idf = np.log((N - df + 0.5) / (df + 0.5) + 1.0) * np.array(ingredient_weights)
+        return [(docids, impacts, idf[j], max_impact) for j, (docids, impacts, max_impact) in enumerate(blocks)]
+    
+    def _dense_bm25search_ingredients(self, ingredients_list, ingredient_weights = None, 
+                                      reader = None, docinfo = None, 
+                                      k=1000, k1=1.5, b=0.75, coverage_alpha = 1):
         N = self.ingredient_searcher.num_docs
-        dl = np.array(self.stats['dl'])
+        dl = self.dl
         avgdl = self.stats['avgdl']
 
         terms = ingredients_list
@@ -163,37 +650,426 @@ class IngredientSearcher:
         topk_scores = adjusted_scores[topk_idx]
         order      = np.argsort(-topk_scores)
 
-        return [
-            (docinfo['iids'][topk_idx[i]], float(topk_scores[i]))
-            for i in order
-        ]
+        return topk_idx[order], topk_scores[order]
+    
+    # Same scoring as _bm25search_ingredients, but gathers the precomputed impacts of every term
+    # instead of reading the postings from Lucene
+    def _impact_search_ingredients(self, ingredients_list, ingredient_weights, k=1000, coverage_alpha = 1,
+                                   exhaustive=True, doc_mask=None):
+        with stage('ingredient_postings'):
+            term_postings = self._mask_postings(self._impact_term_postings(ingredients_list, ingredient_weights),
+                                                doc_mask)
+        return self._score_candidates(term_postings, ingredient_weights, self.stats,
+                                      k=k, coverage_alpha=coverage_alpha, exhaustive=exhaustive)
+    
+    # (docids, impacts, factor, max impact) of every query term, read from the impact index
+    def _impact_term_postings(self, ingredients_list, ingredient_weights):
+        index = self.impact_index
+        N = index.num_docs
+        
+        term_postings = []
+        for term, w in zip(ingredients_list, ingredient_weights):
+            docids, impacts, max_impact = index.postings(self.normalizer.normalize(term))
+            df = len(docids)
+            idf = np.log((N - df + 0.5) / (df + 0.5) + 1.0)
+            term_postings.append((docids, impacts, idf * w, max_impact))
+        return term_postings
+    
+    # Scores several ingredient queries at once. The synonym expansion is shared between queries, every distinct
+    # index term is fetched once, and all queries are scored by a single sparse (query x term) @ (term x doc)
+    # product. Per query the result is the same ranked list as search_ingredients(..., exhaustive=True).
+    # k and nsyms can be a single value or one value per query
+    def search_ingredients_batch(self, ingredients_strings, k=1000, nsyms=5, coverage_alpha = 1):
+        return [self._with_iids(docids, scores)
+                for docids, scores in self.rank_ingredients_batch(ingredients_strings, k, nsyms, coverage_alpha)]
+
+    # Same as search_ingredients_batch but returns (internal docids, scores) arrays per query.
+    # doc_masks holds one doc_mask (see rank_ingredients) or None per query
+    def rank_ingredients_batch(self, ingredients_strings, k=1000, nsyms=5, coverage_alpha = 1, doc_masks=None):
+        Q = len(ingredients_strings)
+        ks = k if isinstance(k, (list, tuple)) else [k] * Q
+        nsyms_list = nsyms if isinstance(nsyms, (list, tuple)) else [nsyms] * Q
+        N = self.impact_index.num_docs if self.impact_index is not None else self.ingredient_searcher.num_docs
+        
+        # 1) expand all queries, sharing the groups between queries with the same nsyms
+        memos = defaultdict(dict)
+        with stage('synonyms'):
+            expanded = [self._expand_query(s, n, memos[n]) for s, n in zip(ingredients_strings, nsyms_list)]
+        
+        # 2) one column per distinct index term
+        columns = {}
+        for terms, _ in expanded:
+            for term in terms:
+                index_term = self.normalizer.normalize(term)
+                if index_term not in columns:
+                    columns[index_term] = term
+        blocks = []
+        with stage('ingredient_postings'):
+            for index_term, term in columns.items():
+                if self.impact_index is not None:
+                    docids, impacts, _ = self.impact_index.postings(index_term)
+                else:
+                    docids, impacts, _ = self._lucene_term_impacts(term)
+                blocks.append((docids, impacts))
+        bm25_start = time.perf_counter()
+        column_ids = {index_term: j for j, index_term in enumerate(columns)}
+        df = np.array([len(docids) for docids, _ in blocks], dtype=float)
+        idf = np.log((N - df + 0.5) / (df + 0.5) + 1.0)
+        
+        lengths = [len(docids) for docids, _ in blocks]
+        term_doc = csr_matrix((np.concatenate([impacts for _, impacts in blocks]).astype(float) if blocks else np.empty(0),
+                               np.concatenate([docids for docids, _ in blocks]) if blocks else np.empty(0, dtype=np.int32),
+                               np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)),
+                              shape=(len(blocks), N))
+        term_doc_match = term_doc.copy()
+        term_doc_match.data = np.ones_like(term_doc_match.data)
+        
+        # 3) query x term matrices, one with the BM25 factors (synonym weight * idf), one with match counts
+        rows, cols, factors = [], [], []
+        for q, (terms, weights) in enumerate(expanded):
+            for term, w in zip(terms, weights):
+                j = column_ids[self.normalizer.normalize(term)]
+                rows.append(q)
+                cols.append(j)
+                factors.append(idf[j] * w)
+        query_term = csr_matrix((factors, (rows, cols)), shape=(Q, len(blocks)), dtype=float)
+        query_term_match = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(Q, len(blocks)), dtype=float)
+        
+        scores = query_term @ term_doc
+        scores.sort_indices()
+        matched_counts = query_term_match @ term_doc_match
+        matched_counts.sort_indices()
+        
+        # 4) coverage boost and top-k per query, over the documents matching at least one term
+        results = []
+        for q, (terms, weights) in enumerate(expanded):
+            start, end = matched_counts.indptr[q], matched_counts.indptr[q + 1]
+            candidates = matched_counts.indices[start:end]
+            counts = matched_counts.data[start:end]
+            # the product drops entries that sum to zero (zero-weight synonyms), put them back as zeros
+            row_docids = scores.indices[scores.indptr[q]:scores.indptr[q + 1]]
+            row_scores = scores.data[scores.indptr[q]:scores.indptr[q + 1]]
+            candidate_scores = np.zeros(len(candidates))
+            candidate_scores[np.searchsorted(candidates, row_docids)] = row_scores
+            
+            coverage = counts / np.sum(weights)
+            adjusted_scores = candidate_scores * (1 + coverage_alpha * coverage)
+            if doc_masks is not None and doc_masks[q] is not None:
+                keep = doc_masks[q][candidates]
+                candidates, adjusted_scores = candidates[keep], adjusted_scores[keep]
+            k_q = ks[q]
+            if k_q == "all":
+                k_q = np.sum(adjusted_scores > 0)
+            order = top_k_indices(adjusted_scores, k_q)
+            results.append((candidates[order], adjusted_scores[order]))
+        STAGE_SECONDS.observe(time.perf_counter() - bm25_start, 'bm25')
+        # every distinct term is read once for the whole batch
+        POSTINGS_TOUCHED.inc(int(sum(lengths)), 'ingredients')
+        CANDIDATES_SCORED.inc(matched_counts.nnz, 'ingredients')
+        return results
+    
+    # Sparse accumulator: sums the per-term contributions over the union of the postings only, so the
+    # cost follows the number of postings touched instead of the corpus size.
+    # term_postings holds one (docids, impacts, factor, max impact) tuple per query term, the contribution
+    # of a posting is factor * impact
+    def _score_candidates(self, term_postings, ingredient_weights, docinfo, k=1000, coverage_alpha = 1,
+                          exhaustive=True):
+        total_postings = sum(len(docids) for docids, _, _, _ in term_postings)
+        if total_postings == 0:
+            self.last_query_stats = {'postings_total': 0, 'postings_scored': 0, 'postings_skipped': 0}
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+        with stage('bm25'):
+            if exhaustive or k == "all":
+                candidates, scores, matched_counts = self._accumulate(term_postings)
+                scored = total_postings
+            else:
+                candidates, scores, matched_counts, scored = self._maxscore_accumulate(
+                    term_postings, np.sum(ingredient_weights), k, coverage_alpha)
+            
+            coverage = matched_counts / np.sum(ingredient_weights)
+            adjusted_scores = scores * (1 + coverage_alpha * coverage)
+            
+            if k == "all":
+                k = np.sum(adjusted_scores > 0)
+            order = top_k_indices(adjusted_scores, k)
+        self.last_query_stats = {'postings_total': total_postings, 'postings_scored': scored,
+                                 'postings_skipped': total_postings - scored}
+        POSTINGS_TOUCHED.inc(scored, 'ingredients')
+        # last_query_stats stays on the thread that scored, which is a branch worker under CustomRecipeSearcher
+        POSTINGS_SKIPPED.inc(total_postings - scored, 'ingredients')
+        CANDIDATES_SCORED.inc(len(candidates), 'ingredients')
+        return candidates[order], adjusted_scores[order]
+    
+    # Scores, without any pruning, every document of the postings: (candidates, BM25 sums, matched term counts),
+    # candidates in docid order
+    def _accumulate(self, term_postings):
+        all_docids = np.concatenate([docids for docids, _, _, _ in term_postings])
+        candidates, inverse = np.unique(all_docids, return_inverse=True)
+        contributions = np.concatenate([factor * impacts for _, impacts, factor, _ in term_postings])
+        scores = np.bincount(inverse, weights=contributions, minlength=len(candidates))
+        matched_counts = np.bincount(inverse, minlength=len(candidates))
+        return candidates, scores, matched_counts
+    
+    # Term-at-a-time MaxScore. Terms are processed by decreasing upper bound (factor * max impact). A document
+    # matching only the remaining terms can score at most sum(remaining bounds) * (1 + alpha * remaining / G),
+    # i.e. the coverage multiplier is folded into the bound. As soon as the k-th best partial score (a lower
+    # bound, contributions are non-negative) beats that, no new document can enter the top-k: the remaining
+    # postings lists are only probed for the current candidates and everything else in them is skipped.
+    # Candidates whose own upper bound falls below the threshold are dropped along the way.
+    def _maxscore_accumulate(self, term_postings, weight_sum, k, coverage_alpha):
+        terms = sorted((t for t in term_postings if len(t[0]) > 0),
+                       key=lambda t: t[2] * t[3], reverse=True)
+        bounds = np.array([factor * max_impact for _, _, factor, max_impact in terms])
+        # remaining_bounds[i] = sum of the bounds of terms i, i+1, ...
+        remaining_bounds = np.append(np.cumsum(bounds[::-1])[::-1], 0.0)
+        def boost(counts):
+            return 1 + coverage_alpha * counts / weight_sum
+
+        candidates = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=float)
+        counts = np.empty(0, dtype=np.int64)
+        threshold = -np.inf
+        scored = 0
+        for i, (docids, impacts, factor, _) in enumerate(terms):
+            remaining = len(terms) - i
+            if threshold > remaining_bounds[i] * boost(remaining):
+                # only the current candidates can still make it, look them up in the postings
+                pos = np.searchsorted(docids, candidates)
+                pos = np.minimum(pos, len(docids) - 1)
+                hit = docids[pos] == candidates
+                scores[hit] += factor * impacts[pos[hit]]
+                counts[hit] += 1
+                scored += int(hit.sum())
+            else:
+                merged, inverse = np.unique(np.concatenate([candidates, docids]), return_inverse=True)
+                merged_scores = np.zeros(len(merged))
+                merged_counts = np.zeros(len(merged), dtype=np.int64)
+                merged_scores[inverse[:len(candidates)]] = scores
+                merged_counts[inverse[:len(candidates)]] = counts
+                merged_scores[inverse[len(candidates):]] += factor * impacts
+                merged_counts[inverse[len(candidates):]] += 1
+                candidates, scores, counts = merged, merged_scores, merged_counts
+                scored += len(docids)
+
+            if 0 < k <= len(candidates):
+                lower = scores * boost(counts)
+                threshold = np.partition(lower, len(lower) - k)[len(lower) - k]
+                remaining = len(terms) - i - 1
+                if threshold > remaining_bounds[i + 1] * boost(remaining):
+                    upper = (scores + remaining_bounds[i + 1]) * boost(counts + remaining)
+                    keep = upper >= threshold
+                    candidates, scores, counts = candidates[keep], scores[keep], counts[keep]
+        return candidates, scores, counts, scored
 
 class RecipeSearcher:
-    def __init__(self, content_path):
+    def __init__(self, content_path, postings_cache = None, stats_path = None, doc_table = None):
+        self.postings_cache = postings_cache
+        self.doc_table = doc_table
         #self.ingredient_reader = LuceneIndexReader(ingredient_path)
         self.content_reader = LuceneIndexReader(content_path)
         #self.ingredient_searcher = LuceneSearcher(ingredient_path)
         self.content_searcher = LuceneSearcher(content_path)
-        self.content_docinfo = []
-        for i in range(self.content_searcher.num_docs):
-            self.content_docinfo.append({
-                'n': len(self.content_reader.analyze(json.loads(self.content_searcher.doc(i).raw())['contents'])),
-                'id': i,
-                'iid': self.content_searcher.doc(i).docid()
-            })
+        # dl: document lengths by internal docid, iids: external ids, avgdl: mean length (the Dirichlet mu),
+        # total_terms: collection length
+        self.content_stats = self._load_content_stats(content_path, stats_path)
+
+    # Loads the statistics written by scripts/generate_index_statistics.py. If they are missing or belong to
+    # another build of the index they are recomputed from the index, which takes minutes on the full collection
+    def _load_content_stats(self, content_path, stats_path):
+        meta_path = os.path.join(stats_path, 'meta.json') if stats_path is not None else None
+        if meta_path is not None and os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['num_docs'] == self.content_searcher.num_docs and meta['index_version'] == index_version(content_path):
+                if self.doc_table is not None:
+                    iids = self.doc_table.content_ids
+                else:
+                    with open(os.path.join(stats_path, 'iids.txt'), 'r', encoding='utf-8') as f:
+                        iids = f.read().split('\n')
+                return {
+                    'dl': np.load(os.path.join(stats_path, 'dl.npy'), mmap_mode='r'),
+                    'iids': iids,
+                    'avgdl': meta['avgdl'],
+                    'total_terms': meta['total_terms'],
+                }
+            warnings.warn(f"Content statistics in {stats_path} do not match the index at {content_path}, recomputing them")
+        else:
+            warnings.warn(f"No content statistics at {stats_path}, recomputing them. "
+                          "Run scripts/generate_index_statistics.py to make the startup fast")
+        dl, iids, total_terms = compute_content_stats(content_path)
+        return {
+            'dl': dl,
+            'iids': iids,
+            'avgdl': float(np.sum(dl)) / len(dl) if len(dl) > 0 else 0.0,
+            'total_terms': total_terms,
+        }
+
+    # (docids, tfs) arrays of an analyzed term, served from the shared postings cache when there is one
+    def _postings(self, term, reader = None):
+        if reader is None:
+            reader = self.content_reader
+        load = lambda: postings_to_arrays(reader.get_postings_list(term, analyzer=None))
+        if self.postings_cache is None or reader is not self.content_reader:
+            return load()
+        return self.postings_cache.get(('content', term), load)
 
     # Query likelihood model with dirichlet smoothing.
     # Should be run on the keywords part of the query, which is then combined with a custom score from ingredients
     def dirichlet_search(self, query, reader = None, docinfo = None, k=1000):
         # can't directly set these by default, so here's a workaround
         if docinfo is None:
-            docinfo = self.content_docinfo
+            docinfo = self.content_stats
+        return self._with_iids(*self.rank_keywords(query, reader, docinfo, k), docinfo)
+
+    # Same as dirichlet_search but returns the (internal docids, scores) arrays, best first.
+    # doc_mask (boolean, one entry per docid) restricts the ranking to the documents where it is True
+    def rank_keywords(self, query, reader = None, docinfo = None, k=1000, doc_mask=None):
+        if docinfo is None:
+            docinfo = self.content_stats
         if reader is None:
             reader = self.content_reader
+        with stage('analyze'):
+            query_terms = reader.analyze(query)
+        with stage('keyword_postings'):
+            postings = {term: self._postings(term, reader) for term in set(query_terms)}
+        with stage('dirichlet'):
+            return self._dirichlet_rank(query_terms, postings, reader, docinfo, k, doc_mask)
+
+    # Ranked (docids, scores) arrays -> [(external id, score), ...]
+    def _with_iids(self, docids, scores, docinfo = None):
+        iids = (docinfo if docinfo is not None else self.content_stats)['iids']
+        return [(iids[docid], float(score)) for docid, score in zip(docids.tolist(), scores)]
+
+    # Every document containing a query term, as unranked (docids, scores) arrays in docid order,
+    # the input of the threshold algorithm fusion
+    def score_keywords(self, query, doc_mask=None):
+        reader = self.content_reader
+        with stage('analyze'):
+            query_terms = reader.analyze(query)
+        with stage('keyword_postings'):
+            postings = {term: self._postings(term, reader) for term in set(query_terms)}
+        with stage('dirichlet'):
+            return self._dirichlet_scores(query_terms, postings, self.content_stats, doc_mask)
+    
+    # Runs dirichlet_search for several queries. Every distinct term is fetched once for the whole batch and
+    # all queries are scored together, see rank_keywords_batch. Scores match dirichlet_search up to rounding.
+    # k can be a single value or one value per query
+    def dirichlet_search_batch(self, queries, k=1000):
+        return [self._with_iids(docids, scores) for docids, scores in self.rank_keywords_batch(queries, k)]
+
+    # Same as dirichlet_search_batch but returns (internal docids, scores) arrays per query.
+    # doc_masks holds one doc_mask (see rank_keywords) or None per query.
+    # The log likelihood of a document splits into a part that only depends on the query, a part that only
+    # depends on the document length, and one term per query term the document contains:
+    #   sum_t log((tf + mu*cf/C) / (dl + mu))
+    #     = sum_t log(mu*cf/C) - n*log(dl + mu) + sum_{t, tf > 0} log(1 + tf*C/(mu*cf))
+    # (n is the number of query terms). The last sum is one sparse product of a query x term matrix (how often
+    # each query has the term) with a term x document matrix of the log(1 + tf*C/(mu*cf)), over the union of
+    # the candidates of the batch, like rank_ingredients_batch does for BM25
+    def rank_keywords_batch(self, queries, k=1000, doc_masks=None):
+        reader = self.content_reader
+        docinfo = self.content_stats
+        mu = docinfo['avgdl']
+        C = docinfo['total_terms']
+        N = len(docinfo['dl'])
+        Q = len(queries)
+        ks = k if isinstance(k, (list, tuple)) else [k] * Q
+        if doc_masks is None:
+            doc_masks = [None] * Q
+        with stage('analyze'):
+            analyzed = [reader.analyze(query) for query in queries]
+        postings = {}
+        with stage('keyword_postings'):
+            for query_terms in analyzed:
+                for term in query_terms:
+                    if term not in postings:
+                        postings[term] = self._postings(term, reader)
+        with stage('dirichlet'):
+            # terms that do not occur in the collection are left out, like in _dirichlet_scores
+            known = [term for term, (docids, _) in postings.items() if len(docids) > 0]
+            columns = {term: j for j, term in enumerate(known)}
+            blocks = [postings[term] for term in known]
+            cf = np.array([int(tfs.sum()) for _, tfs in blocks], dtype=float)
+            background = np.log(mu * cf / C)
+            lengths = [len(docids) for docids, _ in blocks]
+            gain_data = [np.log1p(tfs * (C / (mu * cf_j))) for (_, tfs), cf_j in zip(blocks, cf)]
+            term_doc = csr_matrix((np.concatenate(gain_data) if blocks else np.empty(0),
+                                   np.concatenate([docids for docids, _ in blocks]) if blocks
+                                   else np.empty(0, dtype=np.int32),
+                                   np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)),
+                                  shape=(len(blocks), N))
+            rows, cols = [], []
+            for q, query_terms in enumerate(analyzed):
+                for term in query_terms:
+                    if term in columns:
+                        rows.append(q)
+                        cols.append(columns[term])
+            # repeated query terms are summed into their count
+            query_term = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(Q, len(blocks)), dtype=float)
+            # every posting adds a positive log(1 + ...), so the product keeps exactly the candidates of each query
+            gains = query_term @ term_doc
+            gains.sort_indices()
+            query_background = query_term @ background
+            query_lengths = np.asarray(query_term.sum(axis=1)).ravel()
+
+            results = []
+            for q in range(Q):
+                candidates = gains.indices[gains.indptr[q]:gains.indptr[q + 1]]
+                scores = (query_background[q] + gains.data[gains.indptr[q]:gains.indptr[q + 1]]
+                          - query_lengths[q] * np.log(docinfo['dl'][candidates] + mu))
+                if doc_masks[q] is not None:
+                    keep = doc_masks[q][candidates]
+                    candidates, scores = candidates[keep], scores[keep]
+                k_q = len(scores) if ks[q] == "all" else ks[q]
+                order = top_k_indices(scores, k_q)
+                results.append((candidates[order], scores[order]))
+        # every distinct term is read once for the whole batch
+        POSTINGS_TOUCHED.inc(int(sum(lengths)), 'keywords')
+        CANDIDATES_SCORED.inc(gains.nnz, 'keywords')
+        return results
+    
+    # Top k of _dirichlet_scores, picked with argpartition
+    def _dirichlet_rank(self, query_terms, postings, reader, docinfo, k, doc_mask=None):
+        candidates, scores = self._dirichlet_scores(query_terms, postings, docinfo, doc_mask)
+        if k == "all":
+            k = len(scores)
+        order = top_k_indices(scores, k)
+        return candidates[order], scores[order]
+    
+    # Scores the documents containing at least one of the query terms. `postings` maps every query term
+    # to its (docids, tfs) arrays. All log likelihoods are computed at once on a candidates x terms matrix.
+    # Terms that do not occur in the collection are left out, they would add the same -inf to every document.
+    # With a doc_mask only the documents inside of it are scored, the collection frequencies stay the same
+    def _dirichlet_scores(self, query_terms, postings, docinfo, doc_mask=None):
+        mu = docinfo['avgdl']
+        C = docinfo['total_terms'] # total number of terms in collection
+        blocks = [postings[term] for term in query_terms if len(postings[term][0]) > 0]
+        if not blocks:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+        cf = [int(tfs.sum()) for _, tfs in blocks]
+        if doc_mask is not None:
+            blocks = [(docids[doc_mask[docids]], tfs[doc_mask[docids]]) for docids, tfs in blocks]
+        
+        candidates = np.unique(np.concatenate([docids for docids, _ in blocks]))
+        POSTINGS_TOUCHED.inc(sum(len(docids) for docids, _ in blocks), 'keywords')
+        CANDIDATES_SCORED.inc(len(candidates), 'keywords')
+        tf = np.zeros((len(candidates), len(blocks)))
+        for j, (docids, tfs) in enumerate(blocks):
+            tf[np.searchsorted(candidates, docids), j] = tfs
+        D = docinfo['dl'][candidates] + mu
+        
+        log_likelihoods = np.log((tf + np.array([mu * cf_j / C for cf_j in cf])) / D[:, None])
+        # summed term by term, in query order, like the reference implementation
+        scores = np.zeros(len(candidates))
+        for j in range(len(blocks)):
+            scores += log_likelihoods[:, j]
+        return candidates, scores
+    
+    # Reference implementation of _dirichlet_rank (python loop over candidates and terms, bisect top-k),
+    # kept to check the vectorised version against, see evaluation/check_dirichlet_parity.py
+    def _dirichlet_rank_loop(self, query_terms, postings, reader, docinfo, k):
         searcher = self.content_searcher
-        query_terms = reader.analyze(query)
-        top_k = []
-        mu = np.sum([doc['n'] for doc in docinfo]) / len(docinfo)
+        mu = docinfo['avgdl']
         
         # define a list of docs that we want to go over, it should contain at least a single value in the query
         docs = set()
@@ -201,21 +1077,19 @@ class RecipeSearcher:
         term_c_frequencies = {}
         #print("Retrieving the term frequencies")
         for term in query_terms:
-            posting_list = reader.get_postings_list(term, analyzer=None)
-            term_c_frequencies[term] = reader.get_term_counts(term, analyzer=None)[1]
-            term_doc = {}
-            for posting in posting_list:
-                docs.add(posting.docid)
-                term_doc[posting.docid] = posting.tf
-            term_doc_frequencies[term] = term_doc
+            docids, tfs = postings[term]
+            # the collection frequency is the sum of the term frequencies over the postings
+            term_c_frequencies[term] = int(tfs.sum())
+            docids = docids.tolist()
+            docs.update(docids)
+            term_doc_frequencies[term] = dict(zip(docids, tfs.tolist()))
                 
         
         #print("Computing likelihoods")
         top_k = []
-        C = reader.stats()['total_terms'] # total number of terms in collection
+        C = docinfo['total_terms'] # total number of terms in collection
         for docid in docs:
-            single_docinfo = docinfo[docid]
-            D = single_docinfo['n'] # number of terms in the document
+            D = docinfo['dl'][docid] # number of terms in the document
             score = 0
             for term in query_terms:
                 cf = term_c_frequencies[term] # get the document and collection frequency
@@ -236,36 +1110,154 @@ class RecipeSearcher:
         
         return top_k
     
+# Identifies everything search results depend on: the commits of both Lucene indexes and the modification times of
+# the derived files (artifact_paths, None entries are skipped). The API caches its results under the version the
+# searcher was started with
+def artifacts_version(ingredient_path, content_path, artifact_paths):
+    parts = [index_version(path) if os.path.isdir(path) else path for path in (ingredient_path, content_path)]
+    for path in artifact_paths:
+        if path is None or not os.path.exists(path):
+            continue
+        # an artifact directory is as new as its newest file
+        files = [entry.path for entry in os.scandir(path) if entry.is_file()] if os.path.isdir(path) else [path]
+        parts.append(f"{path}:{max((os.path.getmtime(f) for f in files), default=0)}")
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+class InvalidCursorError(ValueError):
+    """Raised by CustomRecipeSearcher.search_page for a cursor it did not issue (malformed, altered or signed with
+    another key)"""
+
+class FacetsUnavailableError(RuntimeError):
+    """Raised by CustomRecipeSearcher.facets when the attribute columns are missing or do not match the indexes"""
+
 class CustomRecipeSearcher:
-    def __init__(self, content_path, ingredient_path, index_stats_path, synonym_path = None, recipe_path = None):
-        self.ingredient_searcher = IngredientSearcher(ingredient_path, index_stats_path, synonym_path)
-        self.content_searcher = RecipeSearcher(content_path)
-        if recipe_path is not None:
-            self.recipe_reader = RecipeInfoRetrieval(recipe_path)
-        else:
+    def __init__(self, content_path, ingredient_path, index_stats_path, synonym_path = None, recipe_path = None,
+                 impact_path = None, lemma_path = None, postings_cache_bytes = 256 * 1024 * 1024,
+                 content_stats_path = None, max_workers = 4, ingredient_timeout = None, keyword_timeout = None,
+                 attributes_path = None, doc_table_path = None, cursor_ttl = 300, cursor_bytes = 64 * 1024 * 1024,
+                 cursor_key = None):
+        # one postings cache for both indexes, so the memory budget is shared between them
+        self.postings_cache = PostingsCache(postings_cache_bytes) if postings_cache_bytes else None
+        self.doc_table = self._load_doc_table(doc_table_path, ingredient_path, content_path)
+        self.ingredient_searcher = IngredientSearcher(ingredient_path, index_stats_path, synonym_path, impact_path,
+                                                      lemma_path, self.postings_cache, self.doc_table)
+        self.content_searcher = RecipeSearcher(content_path, self.postings_cache, content_stats_path, self.doc_table)
+        # recipe_path is either the SQLite recipe store or the shelf it was migrated from
+        if recipe_path is None:
             self.recipe_reader = None
+        elif is_recipe_store(recipe_path):
+            self.recipe_reader = RecipeStore(recipe_path)
+        else:
+            self.recipe_reader = RecipeInfoRetrieval(recipe_path)
+        self._build_doc_ids()
+        self.attributes = self._load_attributes(attributes_path)
+        # per thread stats of the last search, see last_fusion_stats
+        self._local = threading.local()
+        # The ingredient and the keyword side of a search run in parallel on this pool, which is shared by all
+        # requests (a search with both sides takes two workers). Both sides spend most of their time in numpy
+        # and in the JVM, which release the GIL. max_workers=0 runs them one after the other.
+        # A side that does not finish within its timeout (seconds, None waits forever) is left out of the
+        # fusion and the search returns the results of the other side
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='recipe-search') if max_workers else None
+        self.ingredient_timeout = ingredient_timeout
+        self.keyword_timeout = keyword_timeout
+        self._version_sources = (ingredient_path, content_path,
+                                 [synonym_path, impact_path, lemma_path, content_stats_path, attributes_path,
+                                  doc_table_path, recipe_path])
+        # the version the searcher was started with
+        self.index_version = self.current_index_version()
+        # rankings of paginated searches (search_page) by query, kept cursor_ttl seconds after their last page was
+        # read, within cursor_bytes
+        self.cursors = ResultCache(max_entries=100000, max_bytes=cursor_bytes, ttl=cursor_ttl, sliding=True)
+        # signs the cursors. Processes serving the same clients need the same key to accept each other's cursors,
+        # without one the cursors are only valid in this process
+        if cursor_key is None:
+            cursor_key = secrets.token_bytes(32)
+        self._cursor_key = cursor_key.encode('utf-8') if isinstance(cursor_key, str) else cursor_key
 
-    # Generic sigmoid function
-    def sigmoid(self, x):
-        return 1 / (1 + math.exp(-x))
-    
-    # Convert each result list into dictionary that returns default 0 if key not found, normalize scores with sigmoid
-    def _convert_scores(self, scores: list[tuple]):
-        res = defaultdict(lambda :{'score': 0, 'rank': 1})
-        for i in range(len(scores)):
-            x = scores[i]
-            res[x[0]] = {
-                'score': self.sigmoid(x[1]),
-                'rank': i + 1
-            }
-        return res
+    # How deep the last fused search of the calling thread read the ingredient and the keyword ranking, and which
+    # side timed out. Kept per thread: the searcher is shared by concurrent requests, each reads its own search
+    @property
+    def last_fusion_stats(self):
+        return getattr(self._local, 'fusion_stats', {})
+
+    @last_fusion_stats.setter
+    def last_fusion_stats(self, stats):
+        self._local.fusion_stats = stats
+
+    # Version of the indexes and derived files on disk right now, a few directory listings and stats. Differs from
+    # index_version once one of them was rebuilt: the searcher keeps the files it opened, picking up a rebuild
+    # needs a restart
+    def current_index_version(self):
+        return artifacts_version(*self._version_sources)
+
+    # The two indexes number their documents differently. Fusion works on one shared id space: the ingredient
+    # index docids, followed by the documents that only exist in the content index.
+    # doc_ids[global id] is the external id (recipe url), content_to_global maps content docids to global ids
+    def _build_doc_ids(self):
+        if self.doc_table is not None:
+            self.doc_ids, self.content_to_global = self.doc_table.doc_ids, self.doc_table.content_to_global
+            self.doc_ids_fingerprint = self.doc_table.meta['doc_ids']
+        else:
+            self.doc_ids, self.content_to_global = global_doc_ids(self.ingredient_searcher.stats['iids'],
+                                                                  self.content_searcher.content_stats['iids'])
+            self.doc_ids_fingerprint = None
+        self.num_ingredient_docs = len(self.ingredient_searcher.stats['iids'])
+    
+    # Ids and document lengths shared between processes (see DocTable). Without it (or when it was built for other
+    # indexes) every process loads them from the index statistics
+    def _load_doc_table(self, doc_table_path, ingredient_path, content_path):
+        if doc_table_path is None or not os.path.exists(os.path.join(doc_table_path, 'meta.json')):
+            return None
+        doc_table = DocTable(doc_table_path)
+        if not doc_table.matches(ingredient_path, content_path):
+            warnings.warn(f"Doc table in {doc_table_path} does not match the indexes, loading the index statistics "
+                          "instead. Run scripts/build_doc_table.py")
+            return None
+        return doc_table
+    
+    # Columns for the range filters. Without them (or when they were built for other indexes) the filters fall
+    # back to hydrating the top k from the recipe shelf and dropping what does not match
+    def _load_attributes(self, attributes_path):
+        if attributes_path is None or not os.path.exists(os.path.join(attributes_path, 'meta.json')):
+            return None
+        attributes = AttributeStore(attributes_path)
+        if not attributes.matches(self.doc_ids, self.doc_ids_fingerprint):
+            warnings.warn(f"Attribute columns in {attributes_path} do not match the indexes, "
+                          "filtering after retrieval instead. Run scripts/build_attribute_columns.py")
+            return None
+        return attributes
+    
+    # Boolean mask over the global ids for the range filters of a search, None when there is nothing to filter
+    # or no attribute columns to filter with
+    def _filter_mask(self, cooking_range=None, calories_range=None, serving_size_range=None):
+        if self.attributes is None:
+            return None
+        ranges = {field: r for field, r in (('total_time', cooking_range), ('calories', calories_range),
+                                            ('yields', serving_size_range)) if r is not None}
+        if not ranges:
+            return None
+        return self.attributes.mask(ranges)
+    
+    # Splits a mask over the global ids into (ingredient index mask, content index mask)
+    def _side_masks(self, doc_mask):
+        if doc_mask is None:
+            return None, None
+        return doc_mask[:self.num_ingredient_docs], doc_mask[self.content_to_global]
+    
+    # Ranked (global ids, scores) arrays -> [(external id, score), ...]
+    def _to_results(self, docids, scores):
+        return [(self.doc_ids[docid], float(score)) for docid, score in zip(docids.tolist(), scores)]
     
     def _filter_by(self, recipe_results, comparison_key, range):
         # Filter the results by the given range
         filtered_results = []
         for recipe in recipe_results:
+            if recipe[2] is None:
+                continue
             if isinstance(comparison_key, str):
-                recipe_value = float(recipe[2].get(comparison_key, None))
+                # same parsing as the attribute columns, "4 servings" -> 4.0, NaN (never in range) if there is no number
+                recipe_value = parse_number(recipe[2].get(comparison_key, None))
             else:
                 recipe_value = recipe[2][comparison_key[0]]
                 for key in comparison_key[1:]:
@@ -275,23 +1267,52 @@ class CustomRecipeSearcher:
         return filtered_results
     
     
+    # fields: only these keys of the recipes are hydrated and returned, implies return_full_recipes
+    # raw_recipes: every recipe is returned as the UTF-8 JSON bytes of the recipe store (recipe_store.encode_results
+    # puts them into a response without decoding them)
+    # How _filter_and_return reads the recipes of a result list: None when it does not need them, otherwise
+    # (raw, hydrated fields). raw: the stored JSON (get_many_raw) goes into the results as it is, only possible
+    # when no range filter has to look at the recipes. The hydrated fields add the filter keys to `fields`
+    def _hydration(self, return_full_recipes=False, cooking_range=None, calories_range=None, serving_size_range=None,
+                   fields=None, raw_recipes=False):
+        if not (return_full_recipes or fields is not None or cooking_range is not None or calories_range is not None
+                or serving_size_range is not None):
+            return None
+        # the range filters need their keys even if the caller did not ask for them
+        filter_fields = [field for field, r in (('total_time', cooking_range), ('calories', calories_range),
+                                                ('yields', serving_size_range)) if r is not None]
+        if raw_recipes and not filter_fields:
+            return True, fields
+        return False, list(dict.fromkeys([*fields, *filter_fields])) if fields is not None else None
+    
+    # `prefetched`: recipe id -> recipe, read as _hydration says, instead of reading them from the recipe reader
     def _filter_and_return(self, top_k, 
                            return_full_recipes=False,
                            cooking_range=None,
                            calories_range=None,
-                           serving_size_range=None):
-        if return_full_recipes or cooking_range is not None or calories_range is not None or serving_size_range is not None:
+                           serving_size_range=None,
+                           fields=None,
+                           raw_recipes=False,
+                           prefetched=None):
+        hydration = self._hydration(return_full_recipes, cooking_range, calories_range, serving_size_range, fields,
+                                    raw_recipes)
+        if hydration is not None:
             if self.recipe_reader is None:
                 raise ValueError("Recipe reader is not set, cannot return full recipes")
+            raw, hydrated_fields = hydration
+            recipe_ids = [recipe_id for recipe_id, _ in top_k]
             # get the full recipe for each recipe id and append it to the top_k list
-            self.recipe_reader.open()
-            for i in range(len(top_k)):
-                recipe = self.recipe_reader.get_recipe(top_k[i][0])
-                if recipe is not None:
-                    top_k[i] = (top_k[i][0], top_k[i][1], recipe)
-                else:
-                    top_k[i] = (top_k[i][0], top_k[i][1], None)
-            self.recipe_reader.close()
+            if prefetched is not None:
+                recipes = [prefetched[recipe_id] for recipe_id in recipe_ids]
+            else:
+                with stage('hydration'):
+                    if raw:
+                        recipes = self.recipe_reader.get_many_raw(recipe_ids, fields)
+                    else:
+                        recipes = self.recipe_reader.get_many(recipe_ids, hydrated_fields)
+            top_k = [(recipe_id, score, recipe) for (recipe_id, score), recipe in zip(top_k, recipes)]
+            if raw:
+                return top_k
             # filter the results by the given ranges
             if cooking_range is not None:
                 top_k = self._filter_by(top_k, 'total_time', cooking_range)
@@ -299,48 +1320,337 @@ class CustomRecipeSearcher:
                 top_k = self._filter_by(top_k, 'calories', calories_range)
             if serving_size_range is not None:
                 top_k = self._filter_by(top_k, 'yields', serving_size_range)
+            if fields is not None and len(hydrated_fields) > len(fields):
+                top_k = [(recipe_id, score, project(recipe, fields)) for recipe_id, score, recipe in top_k]
+            if raw_recipes:
+                # the filters had to look at the recipes, encode what is left
+                top_k = [(recipe_id, score, dumps(recipe)) for recipe_id, score, recipe in top_k]
         return top_k
         
 
 
+    # Runs the ingredient and the keyword side (callables, None for a side the query does not have) on the
+    # executor and waits for both. Returns (ingredient result, keyword result, names of the sides that timed out),
+    # the result of a side that timed out is None. The timeouts count from the moment both sides are submitted.
+    # A side that timed out keeps running in the background until it is done, Python threads can't be killed
+    def _run_branches(self, ingredient_branch, keyword_branch, ingredient_timeout = None, keyword_timeout = None):
+        if self.executor is None or ingredient_branch is None or keyword_branch is None:
+            return (ingredient_branch() if ingredient_branch is not None else None,
+                    keyword_branch() if keyword_branch is not None else None,
+                    [])
+        start = time.monotonic()
+        futures = [
+            ('ingredients', self.executor.submit(ingredient_branch), ingredient_timeout),
+            ('keywords', self.executor.submit(keyword_branch), keyword_timeout),
+        ]
+        results, timed_out = [], []
+        for name, future, timeout in futures:
+            remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+            try:
+                results.append(future.result(timeout=remaining))
+            except FutureTimeoutError:
+                future.cancel()
+                results.append(None)
+                timed_out.append(name)
+        if len(timed_out) == len(futures):
+            raise TimeoutError("Both the ingredient and the keyword search timed out")
+        return results[0], results[1], timed_out
+
+    # Keyword ranking with the docids mapped to the global id space
+    def _rank_keywords(self, keywords_str, k, doc_mask=None):
+        docids, scores = self.content_searcher.rank_keywords(keywords_str, k=k, doc_mask=doc_mask)
+        return self.content_to_global[docids], scores
+
+    # Combines the ranked lists of the two sub-searchers, both given as (docids, scores) arrays in the global
+    # id space, into the (docids, scores) of the top k. A single list keeps its order and gets sigmoid scores,
+    # two lists are fused with the `ranking` strategy, see fusion.FUSION_STRATEGIES
+    def _combine(self, ingredient_ranked, keyword_ranked, k, ranking):
+        if keyword_ranked is None:
+            docids, scores = ingredient_ranked
+            return docids[:k], fusion.sigmoid(scores[:k])
+        if ingredient_ranked is None:
+            docids, scores = keyword_ranked
+            return docids[:k], fusion.sigmoid(scores[:k])
+        return fusion.fuse([ingredient_ranked, keyword_ranked], k, ranking)
+    
+    # Fuses the ingredient and keyword rankings with the threshold algorithm, which reads both of them only as
+    # deep as needed for the fused top k to be final. With a strategy that only needs the scores (see
+    # fusion.reads_scores_only) the ingredient side is a RankedList: MaxScore ranks it k deep on the branch worker,
+    # and again twice as deep only when the threshold is not met yet, so an easy query never scores the long
+    # tail of its postings. Rank and min-max strategies need the complete ingredient ranking. The keyword side
+    # has no bounds to prune with, all its candidates are scored once and read through a partial sort as deep
+    # as needed. The deeper ingredient reads run on the calling thread, without the ingredient timeout
+    def _adaptive_fuse(self, ingredients_str, keywords_str, k, nsyms, ranking, doc_mask=None):
+        ingredient_mask, content_mask = self._side_masks(doc_mask)
+        def ingredient_branch():
+            if not fusion.reads_scores_only(ranking):
+                return fusion.CandidateList(*self.ingredient_searcher.score_ingredients(
+                    ingredients_str, nsyms, doc_mask=ingredient_mask))
+            ranked = self.ingredient_searcher.ranked_ingredients(ingredients_str, nsyms, doc_mask=ingredient_mask)
+            ranked.top(k)
+            return ranked
+        def keyword_branch():
+            docids, scores = self.content_searcher.score_keywords(keywords_str, content_mask)
+            # ties ranked by content docid, like rank_keywords does
+            return fusion.CandidateList(self.content_to_global[docids], scores, tiebreak=docids)
+        ingredient_list, keyword_list, timed_out = self._run_branches(
+            ingredient_branch, keyword_branch, self.ingredient_timeout, self.keyword_timeout)
+        if timed_out:
+            # only one side made it, rank it like a query that has only that side
+            remaining = ingredient_list if ingredient_list is not None else keyword_list
+            docids, scores = remaining.ranked(k)
+            self.last_fusion_stats = {'depths': [len(docids) if ingredient_list is not None else 0,
+                                                 len(docids) if keyword_list is not None else 0],
+                                      'timed_out': timed_out}
+            return docids, fusion.sigmoid(scores)
+        with stage('fusion'):
+            docids, scores, stats = fusion.threshold_fuse([ingredient_list, keyword_list], k, ranking)
+        self.last_fusion_stats = dict(stats, timed_out=[])
+        return docids, scores
+
     # Does a search and returns combined results
     # Simple = sum of sigmoid of sub scores is score
+    # When both ingredients and keywords are given every side retrieves k*10 results, with adaptive_depth=True
+    # the sides are instead read incrementally until the fused top k is final (see fusion.threshold_fuse).
+    # last_fusion_stats tells how deep each side was read.
+    # With attribute columns the range filters are applied before the top k is selected, so a search returns k
+    # results whenever k matching documents exist. Without them the top k is filtered afterwards.
+    # fields (e.g. ['title', 'image', 'ratings']) returns only those keys of every recipe, for list views that do
+    # not need the instructions and ingredient lists. raw_recipes=True returns the recipes as stored JSON bytes, for
+    # responses built with recipe_store.encode_results
     def search(self, ingredients_str="", keywords_str="", k=1000, nsyms=5, ranking='simple', return_full_recipes=False,
-               cooking_range=None, calories_range=None, serving_size_range=None):
-        ingredient_results = None
-        keyword_results = None
+               cooking_range=None, calories_range=None, serving_size_range=None, adaptive_depth=False, fields=None,
+               raw_recipes=False):
+        with SEARCH_SECONDS.time():
+            docids, scores, ranges = self.rank(ingredients_str, keywords_str, k, nsyms, ranking, cooking_range,
+                                               calories_range, serving_size_range, adaptive_depth)
+            return self._filter_and_return(self._to_results(docids, scores), return_full_recipes, *ranges, fields,
+                                           raw_recipes)
+    
+    # The ranking part of search: the (global docids, scores) arrays of the top k, best first, and the
+    # (cooking, calories, serving size) ranges that are left for _filter_and_return. Those are None when the
+    # attribute columns already applied them
+    def rank(self, ingredients_str="", keywords_str="", k=1000, nsyms=5, ranking='simple', cooking_range=None,
+             calories_range=None, serving_size_range=None, adaptive_depth=False):
         if ingredients_str == "" and keywords_str == "":
             raise ValueError("Both ingredients and keywords cannot be empty")
-        if keywords_str == "":
-            ingredient_results = self._convert_scores(self.ingredient_searcher.search_ingredients(ingredients_str, k, nsyms))
-            ingredient_results = sorted([(ing, ingredient_results[ing]['score']) for ing in ingredient_results], key=lambda x: x[1], reverse=True)
-            return self._filter_and_return(ingredient_results, return_full_recipes, cooking_range, calories_range, serving_size_range)
-        elif ingredients_str == "":
-            keyword_results = self._convert_scores(self.content_searcher.dirichlet_search(keywords_str, k=k))
-            keyword_results = sorted([(ing, keyword_results[ing]['score']) for ing in keyword_results], key=lambda x: x[1], reverse=True)
-            return self._filter_and_return(keyword_results, return_full_recipes, cooking_range, calories_range, serving_size_range)
+        if ingredients_str != "" and keywords_str != "":
+            # only checked when two lists are fused, a single side ignores the strategy
+            fusion.get_strategy(ranking)
+        doc_mask = self._filter_mask(cooking_range, calories_range, serving_size_range)
+        if doc_mask is not None:
+            # already filtered, only the hydration is left for _filter_and_return
+            cooking_range, calories_range, serving_size_range = None, None, None
+        ranges = (cooking_range, calories_range, serving_size_range)
+        if adaptive_depth and ingredients_str != "" and keywords_str != "":
+            return (*self._adaptive_fuse(ingredients_str, keywords_str, k, nsyms, ranking, doc_mask), ranges)
+        # when both sides are fused, every side retrieves k*10 results
+        depth = k * 10 if ingredients_str != "" and keywords_str != "" else k
+        ingredient_mask, content_mask = self._side_masks(doc_mask)
+        ingredient_ranked, keyword_ranked, timed_out = self._run_branches(
+            (lambda: self.ingredient_searcher.rank_ingredients(ingredients_str, depth, nsyms, doc_mask=ingredient_mask))
+            if ingredients_str != "" else None,
+            (lambda: self._rank_keywords(keywords_str, depth, content_mask)) if keywords_str != "" else None,
+            self.ingredient_timeout, self.keyword_timeout)
+        self.last_fusion_stats = {
+            'depths': [len(ranked[0]) if ranked is not None else 0 for ranked in (ingredient_ranked, keyword_ranked)],
+            'timed_out': timed_out,
+        }
+        with stage('fusion'):
+            return (*self._combine(ingredient_ranked, keyword_ranked, k, ranking), ranges)
+    
+    # Paginated search. Without a cursor the query is ranked once, up to max_results deep, and the first page is
+    # returned with a cursor for the next one. The cursor carries the query and the offset of the next page,
+    # signed, so any process with the same cursor_key can answer it. The ranking is kept as compact (docids, scores)
+    # arrays, by query, until no page of it was read for `cursor_ttl` seconds: the next page then costs only its
+    # hydration. A cursor whose ranking is not there (expired, evicted, or ranked by another process) ranks the
+    # query again. The search arguments of the first request apply to all pages (the other arguments are ignored
+    # when a cursor is given). Returns (results, cursor of the next page or None on the last page). Raises
+    # InvalidCursorError for a cursor that was not issued with this key.
+    # Range filters the attribute columns can't apply are applied page by page, those pages can be shorter
+    def search_page(self, ingredients_str="", keywords_str="", page_size=10, cursor=None, max_results=1000, nsyms=5,
+                    ranking='simple', return_full_recipes=False, cooking_range=None, calories_range=None,
+                    serving_size_range=None, adaptive_depth=False, fields=None, raw_recipes=False):
+        if cursor is None:
+            query = [ingredients_str, keywords_str, max_results, nsyms, ranking, cooking_range, calories_range,
+                     serving_size_range, adaptive_depth, return_full_recipes, fields, raw_recipes]
+            offset = 0
+        else:
+            query, offset = self._decode_cursor(cursor)
+        docids, scores, ranges = self._page_ranking(query)
+        end = offset + page_size
+        next_cursor = self._encode_cursor(query, end) if end < len(docids) else None
+        results = self._to_results(docids[offset:end], scores[offset:end])
+        return_full_recipes, fields, raw_recipes = query[9:]
+        return self._filter_and_return(results, return_full_recipes, *ranges, fields, raw_recipes), next_cursor
+
+    # The ranking behind the pages of `query` (the search arguments of search_page), from self.cursors or ranked
+    # again. Rankings are deterministic, so every process ranks a query the same way and its pages line up
+    def _page_ranking(self, query):
+        key = json.dumps(query[:9])
+        page = self.cursors.get(key)
+        if page is None:
+            docids, scores, ranges = self.rank(*query[:9])
+            # global ids fit in 32 bits, the scores stay float64 so pages match search() exactly
+            page = (docids.astype(np.int32), np.asarray(scores, dtype=float), ranges)
+            self.cursors.put(key, page, page[0].nbytes + page[1].nbytes)
+        return page
+
+    # search() as a generator, for result lists too long to hold hydrated at once (thousands of full recipes):
+    # the query is ranked in full first, then the results are hydrated and yielded `chunk_size` at a time, so at
+    # most one chunk of recipes is in memory and the first results are out before the last ones are read
+    def iter_search(self, ingredients_str="", keywords_str="", k=1000, nsyms=5, ranking='simple',
+                    return_full_recipes=False, cooking_range=None, calories_range=None, serving_size_range=None,
+                    adaptive_depth=False, fields=None, raw_recipes=False, chunk_size=500):
+        docids, scores, ranges = self.rank(ingredients_str, keywords_str, k, nsyms, ranking, cooking_range,
+                                           calories_range, serving_size_range, adaptive_depth)
+        yield from self.iter_results(docids, scores, ranges, return_full_recipes, fields, raw_recipes, chunk_size)
+    
+    # The hydration half of iter_search, for a ranking from rank()
+    def iter_results(self, docids, scores, ranges=(None, None, None), return_full_recipes=False, fields=None,
+                     raw_recipes=False, chunk_size=500):
+        for start in range(0, len(docids), chunk_size):
+            chunk = self._to_results(docids[start:start + chunk_size], scores[start:start + chunk_size])
+            yield from self._filter_and_return(chunk, return_full_recipes, *ranges, fields, raw_recipes)
+    
+    # A cursor is "<payload>.<signature>": the payload is the query and the offset as base64url JSON, the signature
+    # its truncated HMAC-SHA256
+    def _cursor_signature(self, payload):
+        digest = hmac.new(self._cursor_key, payload.encode('utf-8'), hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+    def _encode_cursor(self, query, offset):
+        payload = base64.urlsafe_b64encode(json.dumps([query, offset], separators=(',', ':')).encode('utf-8'))
+        payload = payload.rstrip(b'=').decode('ascii')
+        return f"{payload}.{self._cursor_signature(payload)}"
+
+    def _decode_cursor(self, cursor):
+        payload, _, signature = cursor.rpartition('.')
+        if not payload or not hmac.compare_digest(signature.encode('utf-8'),
+                                                  self._cursor_signature(payload).encode('ascii')):
+            raise InvalidCursorError(f"Invalid cursor {cursor!r}")
+        query, offset = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return query, offset
+
+    # Facet counts (see AttributeStore.facet_counts) over every document matching the query, not only the
+    # top k: the union of the ingredient and the keyword candidates, after the range filters
+    def facets(self, ingredients_str="", keywords_str="", nsyms=5, cooking_range=None, calories_range=None,
+               serving_size_range=None, top_n=20):
+        if ingredients_str == "" and keywords_str == "":
+            raise ValueError("Both ingredients and keywords cannot be empty")
+        if self.attributes is None or not self.attributes.has_facets:
+            raise FacetsUnavailableError("Facets need the attribute columns, run scripts/build_attribute_columns.py")
+        ingredient_mask, content_mask = self._side_masks(
+            self._filter_mask(cooking_range, calories_range, serving_size_range))
+        ingredient_scored, keyword_scored, _ = self._run_branches(
+            (lambda: self.ingredient_searcher.score_ingredients(ingredients_str, nsyms, doc_mask=ingredient_mask))
+            if ingredients_str != "" else None,
+            (lambda: self.content_searcher.score_keywords(keywords_str, content_mask)) if keywords_str != "" else None)
+        candidates = [np.empty(0, dtype=np.int64)]
+        if ingredient_scored is not None:
+            candidates.append(ingredient_scored[0])
+        if keyword_scored is not None:
+            candidates.append(self.content_to_global[keyword_scored[0]])
+        return self.attributes.facet_counts(np.unique(np.concatenate(candidates)), top_n)
+    
+    # Runs many searches at once and returns one result list per query, in order, identical to calling search
+    # for each of them. Every query is either an (ingredients_str, keywords_str) tuple or a dict of search()
+    # arguments, the keyword arguments of search_batch are the defaults for anything a query does not set.
+    # The sub-searches are batched: synonyms, postings and collection statistics are shared between queries
+    def search_batch(self, queries, k=1000, nsyms=5, ranking='simple', return_full_recipes=False,
+                     cooking_range=None, calories_range=None, serving_size_range=None, adaptive_depth=False,
+                     fields=None, raw_recipes=False):
+        defaults = dict(ingredients_str="", keywords_str="", k=k, nsyms=nsyms, ranking=ranking,
+                        return_full_recipes=return_full_recipes, cooking_range=cooking_range,
+                        calories_range=calories_range, serving_size_range=serving_size_range,
+                        adaptive_depth=adaptive_depth, fields=fields, raw_recipes=raw_recipes)
+        params = []
+        for query in queries:
+            p = dict(defaults)
+            if isinstance(query, dict):
+                p.update(query)
+            else:
+                p['ingredients_str'], p['keywords_str'] = query
+            if p['ingredients_str'] == "" and p['keywords_str'] == "":
+                raise ValueError("Both ingredients and keywords cannot be empty")
+            if p['ingredients_str'] != "" and p['keywords_str'] != "":
+                fusion.get_strategy(p['ranking'])
+            p['doc_mask'] = self._filter_mask(p['cooking_range'], p['calories_range'], p['serving_size_range'])
+            if p['doc_mask'] is not None:
+                p['cooking_range'], p['calories_range'], p['serving_size_range'] = None, None, None
+            params.append(p)
         
-        ingredient_results = self._convert_scores(self.ingredient_searcher.search_ingredients(ingredients_str, k*10, nsyms))
-        keyword_results = self._convert_scores(self.content_searcher.dirichlet_search(keywords_str, k=k*10))
-        top_k = []
-        match ranking:
-            case 'simple':
-                for key in set(list(ingredient_results.keys()) + list(keyword_results.keys())):
-                    bisect.insort(top_k, (key, ingredient_results[key]['score'] + keyword_results[key]['score']), key=lambda x:x[1])
-                    if len(top_k) > k:
-                        top_k.pop(0)
-            case _:
-                for key in set(list(ingredient_results.keys()) + list(keyword_results.keys())):
-                    ingredient_results_key = ingredient_results.get(key)
-                    keyword_results_key = keyword_results.get(key)
-                    ingr_score = ingredient_results_key['score'] / ingredient_results_key['rank']
-                    keyword_score = keyword_results_key['score'] / keyword_results_key['rank']
-                    bisect.insort(top_k, (key, ingr_score + keyword_score), key=lambda x:x[1])
-                    if len(top_k) > k:
-                        top_k.pop(0)
-        top_k.reverse()
-        top_k = top_k[:k]
-        return self._filter_and_return(top_k, return_full_recipes, cooking_range, calories_range, serving_size_range)
+        # same retrieval depth as search: k*10 from every side when both sides are fused
+        def depth(p):
+            return p['k'] * 10 if p['ingredients_str'] != "" and p['keywords_str'] != "" else p['k']
+        # the threshold algorithm decides the depth per query, those queries are not part of the batched retrieval
+        def adaptive(p):
+            return p['adaptive_depth'] and p['ingredients_str'] != "" and p['keywords_str'] != ""
+        with_ingredients = [i for i, p in enumerate(params) if p['ingredients_str'] != "" and not adaptive(p)]
+        with_keywords = [i for i, p in enumerate(params) if p['keywords_str'] != "" and not adaptive(p)]
+        # the two batched sides run in parallel, without timeouts: a batch is never degraded
+        side_masks = [self._side_masks(p['doc_mask']) for p in params]
+        ingredient_ranked, keyword_ranked, _ = self._run_branches(
+            lambda: self.ingredient_searcher.rank_ingredients_batch(
+                [params[i]['ingredients_str'] for i in with_ingredients],
+                k=[depth(params[i]) for i in with_ingredients],
+                nsyms=[params[i]['nsyms'] for i in with_ingredients],
+                doc_masks=[side_masks[i][0] for i in with_ingredients]),
+            lambda: self.content_searcher.rank_keywords_batch(
+                [params[i]['keywords_str'] for i in with_keywords],
+                k=[depth(params[i]) for i in with_keywords],
+                doc_masks=[side_masks[i][1] for i in with_keywords]))
+        ingredient_results = dict(zip(with_ingredients, ingredient_ranked))
+        keyword_results = {
+            i: (self.content_to_global[docids], scores)
+            for i, (docids, scores) in zip(with_keywords, keyword_ranked)
+        }
+        
+        ranked = []
+        for i, p in enumerate(params):
+            if adaptive(p):
+                ranked.append(self._to_results(*self._adaptive_fuse(p['ingredients_str'], p['keywords_str'], p['k'],
+                                                                    p['nsyms'], p['ranking'], p['doc_mask'])))
+            else:
+                ranked.append(self._to_results(*self._combine(ingredient_results.get(i), keyword_results.get(i),
+                                                              p['k'], p['ranking'])))
+        
+        # the hydration is shared as well: every recipe is read once for all queries that read it the same way
+        # (see _hydration), with one get_many / get_many_raw per distinct way
+        hydrations = [self._hydration(p['return_full_recipes'], p['cooking_range'], p['calories_range'],
+                                      p['serving_size_range'], p['fields'], p['raw_recipes']) for p in params]
+        wanted = {}
+        for top_k, hydration in zip(ranked, hydrations):
+            if hydration is not None:
+                raw, hydrated_fields = hydration
+                key = (raw, tuple(hydrated_fields) if hydrated_fields is not None else None)
+                wanted.setdefault(key, {}).update(dict.fromkeys(recipe_id for recipe_id, _ in top_k))
+        if wanted and self.recipe_reader is None:
+            raise ValueError("Recipe reader is not set, cannot return full recipes")
+        prefetched = {}
+        with stage('hydration'):
+            for (raw, hydrated_fields), recipe_ids in wanted.items():
+                read = self.recipe_reader.get_many_raw if raw else self.recipe_reader.get_many
+                recipes = read(list(recipe_ids), list(hydrated_fields) if hydrated_fields is not None else None)
+                prefetched[(raw, hydrated_fields)] = dict(zip(recipe_ids, recipes))
+        
+        results = []
+        for top_k, hydration, p in zip(ranked, hydrations, params):
+            recipes = None
+            if hydration is not None:
+                recipes = prefetched[(hydration[0], tuple(hydration[1]) if hydration[1] is not None else None)]
+            results.append(self._filter_and_return(top_k, p['return_full_recipes'], p['cooking_range'],
+                                                   p['calories_range'], p['serving_size_range'], p['fields'],
+                                                   p['raw_recipes'], recipes))
+        return results
+    
+    # Stops the worker threads and closes the recipe store, searches can't run in parallel after this
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if isinstance(self.recipe_reader, RecipeStore):
+            self.recipe_reader.close()
         
     
 if __name__ == "__main__":
@@ -367,9 +1677,10 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "-r", "--ranking",
-        choices=["simple", "rrf"],
+        choices=list(fusion.FUSION_STRATEGIES),
         default="simple",
-        help="Fusion method: simple summation or rrf"
+        help="Fusion method: simple (sum of sigmoids), rrf / rank_scaled (sigmoid divided by rank), "
+             "reciprocal_rank (true RRF), combsum or combmnz"
     )
     parser.add_argument(
         "--time-range",
@@ -392,25 +1703,47 @@ if __name__ == "__main__":
         metavar=("MIN","MAX"),
         help="Serving size range, e.g. --servings-range 1 4"
     )
+    parser.add_argument(
+        "--adaptive-depth",
+        action="store_true",
+        help="Read the ingredient and keyword rankings only as deep as the fusion needs instead of 10x the results"
+    )
     parser.add_argument(
         "--full",
         action="store_true",
         help="Include full recipe details in output"
     )
+    parser.add_argument(
+        "--fields",
+        nargs="+",
+        metavar="FIELD",
+        help="Only include these recipe fields in the output, e.g. --fields title image ratings (implies --full)"
+    )
     parser.add_argument(
         "-o", "--output",
         help="Optional path to write results as a JSON file"
     )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile the search and write its collapsed stacks (flamegraph.pl / speedscope input) to PATH"
+    )
     
     args = parser.parse_args()
     searcher = CustomRecipeSearcher(
         CONTENT_INDEX,
         INGREDIENT_INDEX,
         INGREDIENT_STATS,
-        synonym_path=INGREDIENT_SYNONYMS,
-        recipe_path=RECIPE_SHELVES_PATH
+        synonym_path=INGREDIENT_SYNONYMS_STORE if os.path.isdir(INGREDIENT_SYNONYMS_STORE) else INGREDIENT_SYNONYMS,
+        recipe_path=RECIPE_STORE_PATH if os.path.exists(RECIPE_STORE_PATH) else RECIPE_SHELVES_PATH,
+        impact_path=INGREDIENT_IMPACTS if os.path.isdir(INGREDIENT_IMPACTS) else None,
+        lemma_path=INGREDIENT_LEMMAS if os.path.exists(INGREDIENT_LEMMAS) else None,
+        content_stats_path=CONTENT_STATS,
+        attributes_path=ATTRIBUTES,
+        doc_table_path=DOC_TABLE
     )
 
+    profiler = SamplingProfiler().start() if args.profile else None
     results = searcher.search(
         ingredients_str=args.ingredients,
         keywords_str=args.keywords,
@@ -419,8 +1752,13 @@ if __name__ == "__main__":
         return_full_recipes=args.full,
         cooking_range=tuple(args.time_range) if args.time_range else None,
         calories_range=tuple(args.calories_range) if args.calories_range else None,
-        serving_size_range=tuple(args.servings_range) if args.servings_range else None
+        serving_size_range=tuple(args.servings_range) if args.servings_range else None,
+        adaptive_depth=args.adaptive_depth,
+        fields=args.fields
     )
+    if profiler is not None:
+        profiler.stop().save(args.profile)
+        print(f"Profile of {profiler.samples} samples ({profiler.duration * 1000:.0f} ms) written to {args.profile}")
 
     if args.output:
         # Convert tuples to JSON-friendly dicts
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import math
+import os
+import re
+import shelve
+
+import numpy as np
+from tqdm import tqdm
+
+ingredient_stats_path = 'indexes/stats/ingredients_pretokenized.json'
+content_stats_path = 'indexes/stats/content'
+shelves_path = 'files/foodrecipes_shelves/foodrecipes_shelves.db'
+attributes_path = 'indexes/attributes'
+
+# recipe field -> column, the range filters of CustomRecipeSearcher.search work on these
+NUMERIC_FIELDS = ['total_time', 'calories', 'yields']
+# bucket edges of the numeric facets, bucket i holds edges[i-1] <= value < edges[i]
+FACET_BUCKETS = {
+    'total_time': [15, 30, 60, 120],
+    'calories': [250, 500, 750, 1000],
+    'yields': [2, 4, 6, 8],
+}
+
+NUMBER = re.compile(r'\d+(?:,\d{3})*(?:\.\d+)?|\.\d+')
+
+def parse_number(value):
+    """First number in a recipe field ("4 servings" -> 4, "1,250 kcal" -> 1250, 45 -> 45), NaN if there is none"""
+    if isinstance(value, bool) or value is None:
+        return math.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER.search(str(value))
+    if match is None:
+        return math.nan
+    return float(match.group().replace(',', ''))
+
+def global_doc_ids(ingredient_iids, content_iids):
+    """
+    The id space the fused results live in: the ingredient index docids, followed by the
+    documents that only exist in the content index. Returns (external id of every global id,
+    global id of every content index docid as an int64 array).
+    """
+    doc_ids = list(ingredient_iids)
+    global_ids = {iid: i for i, iid in enumerate(doc_ids)}
+    content_to_global = np.empty(len(content_iids), dtype=np.int64)
+    for docid, iid in enumerate(content_iids):
+        if iid not in global_ids:
+            global_ids[iid] = len(doc_ids)
+            doc_ids.append(iid)
+        content_to_global[docid] = global_ids[iid]
+    return doc_ids, content_to_global
+
+def bucket_ids(column, edges):
+    """Bucket of every value, 0 .. len(edges) as in FACET_BUCKETS, len(edges) + 1 for NaN"""
+    buckets = np.digitize(column, edges).astype(np.uint8)
+    buckets[np.isnan(column)] = len(edges) + 1
+    return buckets
+
+def parse_keywords(value):
+    # the scraper gives a list, some recipes have a single comma separated string
+    if isinstance(value, str):
+        value = value.split(',')
+    return [keyword.strip().lower() for keyword in value or [] if keyword.strip()]
+
+def doc_ids_fingerprint(doc_ids):
+    # identifies the docid order the columns were built for
+    return hashlib.sha1('\n'.join(doc_ids).encode('utf-8')).hexdigest()
+
+def build_attribute_columns(ingredient_stats_json_path: str,
+                            content_stats_dir: str,
+                            shelves_db_path: str,
+                            output_dir: str):
+    """
+    Parses the recipe attributes out of the shelf once, so searches can filter and count facets
+    on them without unpickling recipes. Everything is indexed by global doc id (see global_doc_ids).
+    Writes into `output_dir`:
+      - <field>.npy:          float64, NaN when the recipe is missing or the value can't be parsed.
+                              One file per NUMERIC_FIELDS
+      - <field>_buckets.npy:  uint8, facet bucket of the value (see bucket_ids)
+      - category.npy:         int32, position of the category in categories.json, -1 if there is none
+      - keywords_indptr.npy:  int64, the keywords of doc i are keywords_codes[indptr[i]:indptr[i+1]]
+      - keywords_codes.npy:   int32, positions in keywords.json
+      - meta.json:            num_docs, fields, bucket edges and the fingerprint of the doc id order
+    """
+    # retrieval imports this module as scripts.build_attribute_columns, where the other scripts aren't importable
+    # top level
+    from generate_index_statistics import save_array, save_json
+
+    with open(ingredient_stats_json_path, 'r', encoding='utf-8') as f:
+        ingredient_iids = json.load(f)['iids']
+    with open(os.path.join(content_stats_dir, 'iids.txt'), 'r', encoding='utf-8') as f:
+        content_iids = f.read().split('\n')
+    doc_ids, _ = global_doc_ids(ingredient_iids, content_iids)
+
+    columns = {field: np.full(len(doc_ids), np.nan) for field in NUMERIC_FIELDS}
+    category_ids, categories = {}, np.full(len(doc_ids), -1, dtype=np.int32)
+    keyword_ids, keywords_indptr, keywords_codes = {}, np.zeros(len(doc_ids) + 1, dtype=np.int64), []
+    with shelve.open(shelves_db_path, flag='r') as shelf:
+        for i, iid in enumerate(tqdm(doc_ids, desc="Parsing attributes")):
+            recipe = shelf.get(iid)
+            if recipe is not None:
+                for field in NUMERIC_FIELDS:
+                    columns[field][i] = parse_number(recipe.get(field))
+                category = (recipe.get('category') or '').strip()
+                if category:
+                    categories[i] = category_ids.setdefault(category, len(category_ids))
+                for keyword in dict.fromkeys(parse_keywords(recipe.get('keywords'))):
+                    keywords_codes.append(keyword_ids.setdefault(keyword, len(keyword_ids)))
+            keywords_indptr[i + 1] = len(keywords_codes)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for field, column in columns.items():
+        save_array(os.path.join(output_dir, f'{field}.npy'), column)
+        save_array(os.path.join(output_dir, f'{field}_buckets.npy'), bucket_ids(column, FACET_BUCKETS[field]))
+    save_array(os.path.join(output_dir, 'category.npy'), categories)
+    save_array(os.path.join(output_dir, 'keywords_indptr.npy'), keywords_indptr)
+    save_array(os.path.join(output_dir, 'keywords_codes.npy'), np.array(keywords_codes, dtype=np.int32))
+    save_json(os.path.join(output_dir, 'categories.json'), list(category_ids), ensure_ascii=False)
+    save_json(os.path.join(output_dir, 'keywords.json'), list(keyword_ids), ensure_ascii=False)
+    save_json(os.path.join(output_dir, 'meta.json'), {
+        "num_docs": len(doc_ids),
+        "fields": NUMERIC_FIELDS,
+        "buckets": FACET_BUCKETS,
+        "doc_ids": doc_ids_fingerprint(doc_ids)
+    }, indent=2)
+
+    parsed = {field: int(np.sum(~np.isnan(column))) for field, column in columns.items()}
+    print(f"[build_attribute_columns] wrote {len(doc_ids)} docs, parsed values {parsed}, "
+          f"{len(category_ids)} categories, {len(keyword_ids)} keywords → {output_dir}")
+
+if __name__ == "__main__":
+    build_attribute_columns(ingredient_stats_path, content_stats_path, shelves_path, attributes_path)
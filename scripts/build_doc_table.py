@@ -0,0 +1,65 @@
+import json
+import os
+
+import numpy as np
+
+from generate_index_statistics import index_version, save_array, save_json
+from build_attribute_columns import global_doc_ids, doc_ids_fingerprint
+
+ingredient_index_path = 'indexes/ingredients_pretokenized'
+ingredient_stats_path = 'indexes/stats/ingredients_pretokenized.json'
+content_index_path = 'indexes/content'
+content_stats_path = 'indexes/stats/content'
+doc_table_path = 'indexes/doc_table'
+
+def save_strings(output_dir, name, strings):
+    # <name>.npy: the UTF-8 bytes of all strings back to back, <name>_offsets.npy: string i is bytes[offsets[i]:offsets[i+1]]
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    save_array(os.path.join(output_dir, f'{name}.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    save_array(os.path.join(output_dir, f'{name}_offsets.npy'), offsets)
+
+def build_doc_table(ingredient_index_dir: str,
+                    ingredient_stats_json_path: str,
+                    content_index_dir: str,
+                    content_stats_dir: str,
+                    output_dir: str):
+    """
+    Writes the per document tables every search process needs as files it can memory map, instead of each
+    worker building its own Python lists of them (the external ids alone are hundreds of MB as str objects).
+    Writes into `output_dir`:
+      - doc_ids.npy / doc_ids_offsets.npy:          external id of every global doc id (see global_doc_ids)
+      - content_ids.npy / content_ids_offsets.npy:  external id of every content index docid
+      - content_to_global.npy:                      int64, global doc id of every content index docid
+      - ingredient_dl.npy:                          float64, document lengths of the ingredient index
+      - meta.json:                                  sizes, ingredient avgdl, doc id fingerprint and the versions
+                                                    of both indexes, to tell when the table is stale
+    """
+    with open(ingredient_stats_json_path, 'r', encoding='utf-8') as f:
+        ingredient_stats = json.load(f)
+    with open(os.path.join(content_stats_dir, 'iids.txt'), 'r', encoding='utf-8') as f:
+        content_iids = f.read().split('\n')
+    doc_ids, content_to_global = global_doc_ids(ingredient_stats['iids'], content_iids)
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_strings(output_dir, 'doc_ids', doc_ids)
+    save_strings(output_dir, 'content_ids', content_iids)
+    save_array(os.path.join(output_dir, 'content_to_global.npy'), content_to_global)
+    save_array(os.path.join(output_dir, 'ingredient_dl.npy'), np.array(ingredient_stats['dl'], dtype=float))
+    save_json(os.path.join(output_dir, 'meta.json'), {
+        "num_docs": len(doc_ids),
+        "num_ingredient_docs": len(ingredient_stats['iids']),
+        "num_content_docs": len(content_iids),
+        "ingredient_avgdl": ingredient_stats['avgdl'],
+        "doc_ids": doc_ids_fingerprint(doc_ids),
+        "ingredient_index_version": index_version(ingredient_index_dir),
+        "content_index_version": index_version(content_index_dir)
+    }, indent=2)
+
+    print(f"[build_doc_table] wrote {len(doc_ids)} docs ({len(ingredient_stats['iids'])} ingredient, "
+          f"{len(content_iids)} content) → {output_dir}")
+
+if __name__ == "__main__":
+    build_doc_table(ingredient_index_path, ingredient_stats_path, content_index_path, content_stats_path,
+                    doc_table_path)
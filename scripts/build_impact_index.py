@@ -0,0 +1,75 @@
+import json
+import os
+
+import numpy as np
+from pyserini.index.lucene import LuceneIndexReader
+from tqdm import tqdm
+
+from generate_index_statistics import index_version, save_array, save_json
+
+index_path = 'indexes/ingredients_pretokenized'
+stats_path = 'indexes/stats/ingredients_pretokenized.json'
+impacts_path = 'indexes/impacts/ingredients_pretokenized'
+
+# BM25 parameters baked into the impacts, same defaults as IngredientSearcher._bm25search_ingredients
+K1 = 1.5
+B = 0.75
+
+def build_impact_index(index_dir: str,
+                       stats_json_path: str,
+                       output_dir: str,
+                       k1: float = K1,
+                       b: float = B):
+    """
+    Exports the ingredient index into a column-compressed layout (term -> postings) that
+    IngredientSearcher memory maps at startup. Writes into `output_dir`:
+      - terms.json:       [term_0, term_1, …] column order
+      - indptr.npy:       int64, postings of term j live in [indptr[j], indptr[j+1])
+      - docids.npy:       int32, internal docids, ascending within every term
+      - impacts.npy:      float32, tf*(k1+1) / (tf + k1*(1-b+b*dl/avgdl))
+      - max_impacts.npy:  float32, largest impact of every term
+      - meta.json:        num_docs, avgdl, k1, b and the index_version of the index it was exported from
+    The idf part is left out on purpose, it only depends on df and is applied at query time
+    together with the synonym weight.
+    """
+    reader = LuceneIndexReader(index_dir)
+    with open(stats_json_path, 'r', encoding='utf-8') as f:
+        stats = json.load(f)
+    dl = np.array(stats['dl'], dtype=float)
+    avgdl = stats['avgdl']
+    N = len(dl)
+    norm = k1 * (1.0 - b + b * (dl / avgdl))
+
+    terms = []
+    indptr = [0]
+    docid_blocks, impact_blocks, max_impacts = [], [], []
+    for index_term in tqdm(reader.terms(), desc="Exporting postings"):
+        postings = reader.get_postings_list(index_term.term, analyzer=None)
+        if not postings:
+            continue
+        docids = np.fromiter((p.docid for p in postings), dtype=np.int32, count=len(postings))
+        tf = np.fromiter((p.tf for p in postings), dtype=float, count=len(postings))
+        order = np.argsort(docids, kind='stable')
+        docids, tf = docids[order], tf[order]
+        impacts = (tf * (k1 + 1.0) / (tf + norm[docids])).astype(np.float32)
+
+        terms.append(index_term.term)
+        docid_blocks.append(docids)
+        impact_blocks.append(impacts)
+        max_impacts.append(impacts.max())
+        indptr.append(indptr[-1] + len(docids))
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_array(os.path.join(output_dir, 'indptr.npy'), np.array(indptr, dtype=np.int64))
+    save_array(os.path.join(output_dir, 'docids.npy'), np.concatenate(docid_blocks))
+    save_array(os.path.join(output_dir, 'impacts.npy'), np.concatenate(impact_blocks))
+    save_array(os.path.join(output_dir, 'max_impacts.npy'), np.array(max_impacts, dtype=np.float32))
+    save_json(os.path.join(output_dir, 'terms.json'), terms, ensure_ascii=False)
+    # written last: the search processes check it to tell whether the files belong to the index
+    save_json(os.path.join(output_dir, 'meta.json'), {"num_docs": N, "avgdl": avgdl, "k1": k1, "b": b,
+                                                      "index_version": index_version(index_dir)}, indent=2)
+
+    print(f"[build_impact_index] wrote {len(terms)} terms / {indptr[-1]} postings → {output_dir}")
+
+if __name__ == "__main__":
+    build_impact_index(index_path, stats_path, impacts_path)
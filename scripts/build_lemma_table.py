@@ -0,0 +1,49 @@
+import json
+import os
+
+import spacy
+from pyserini.index.lucene import LuceneIndexReader
+from tqdm import tqdm
+
+index_path = 'indexes/ingredients_pretokenized'
+synonyms_path = 'files/other/synonyms.json'
+lemmas_path = 'indexes/stats/ingredient_lemmas.json'
+
+def normalize(doc):
+    # must stay in sync with IngredientNormalizer._spacy_normalize in retrieval.py
+    return "_".join(token.lemma_.lower() for token in doc if not token.is_stop and not token.is_punct)
+
+def build_lemma_table(index_dir: str,
+                      synonyms_json_path: str,
+                      output_json_path: str):
+    """
+    Runs spaCy once over every surface form a query can produce and writes a JSON
+    {surface form: normalised underscore term}, keyed on the stripped, lowercased form that
+    IngredientNormalizer.normalize looks up. Covered forms:
+      - every term of the ingredient index, with underscores turned back into spaces
+      - every key of the synonym dictionary and every synonym it points to
+    """
+    reader = LuceneIndexReader(index_dir)
+    surface_forms = set(t.term.replace('_', ' ') for t in reader.terms())
+    if synonyms_json_path is not None and os.path.exists(synonyms_json_path):
+        with open(synonyms_json_path, 'r', encoding='utf-8') as f:
+            synonyms = json.load(f)
+        for ingredient, entries in synonyms.items():
+            surface_forms.add(ingredient)
+            surface_forms.update(term for term, _, _ in entries)
+    surface_forms = sorted(set(form.strip().lower() for form in surface_forms))
+
+    nlp = spacy.load("en_core_web_sm")
+    table = {}
+    for surface, doc in tqdm(zip(surface_forms, nlp.pipe(surface_forms, batch_size=1024)),
+                             total=len(surface_forms), desc="Lemmatizing"):
+        table[surface] = normalize(doc)
+
+    os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
+    with open(output_json_path, 'w', encoding='utf-8') as out:
+        json.dump(table, out, ensure_ascii=False)
+
+    print(f"[build_lemma_table] wrote {len(table)} surface forms → {output_json_path}")
+
+if __name__ == "__main__":
+    build_lemma_table(index_path, synonyms_path, lemmas_path)
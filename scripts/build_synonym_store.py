@@ -0,0 +1,63 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+synonyms_path = 'files/other/synonyms.json'
+store_path = 'files/other/synonyms_store'
+
+# nsyms used at query time is 5 by default, keep some headroom. The API rejects a larger nsyms (main.MAX_NSYMS)
+TOP_N = 20
+
+def build_synonym_store(synonyms_json_path: str,
+                        output_dir: str,
+                        top_n: int = TOP_N):
+    """
+    Converts the synonym dictionary produced by `scripts/generating_synonyms.py` into an
+    offset-indexed layout that SynonymStore memory maps. Writes into `output_dir`:
+      - terms.json:  [term_0, term_1, …] every ingredient and every synonym, the row id of a term is its position
+      - indptr.npy:  int64, synonyms of term i live in [indptr[i], indptr[i+1])
+      - targets.npy: int32, term ids of the synonyms, best first
+      - scores.npy:  float32, tf-weighted similarity (2nd element of the JSON triples)
+      - sims.npy:    float32, raw cosine similarity (3rd element of the JSON triples)
+    Only the first `top_n` synonyms of every ingredient are kept.
+    """
+    # main imports this module as scripts.build_synonym_store, where the other scripts aren't importable top level
+    from generate_index_statistics import save_array, save_json
+
+    with open(synonyms_json_path, 'r', encoding='utf-8') as f:
+        synonyms = json.load(f)
+
+    term_ids = {}
+    def term_id(term):
+        if term not in term_ids:
+            term_ids[term] = len(term_ids)
+        return term_ids[term]
+
+    rows = {}
+    for ingredient, entries in tqdm(synonyms.items(), desc="Converting synonyms"):
+        rows[term_id(ingredient)] = [(term_id(term), score, sim) for term, score, sim in entries[:top_n]]
+
+    terms = list(term_ids.keys())
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    targets, scores, sims = [], [], []
+    for i in range(len(terms)):
+        row = rows.get(i, [])
+        indptr[i + 1] = indptr[i] + len(row)
+        for target, score, sim in row:
+            targets.append(target)
+            scores.append(score)
+            sims.append(sim)
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_json(os.path.join(output_dir, 'terms.json'), terms, ensure_ascii=False)
+    save_array(os.path.join(output_dir, 'indptr.npy'), indptr)
+    save_array(os.path.join(output_dir, 'targets.npy'), np.array(targets, dtype=np.int32))
+    save_array(os.path.join(output_dir, 'scores.npy'), np.array(scores, dtype=np.float32))
+    save_array(os.path.join(output_dir, 'sims.npy'), np.array(sims, dtype=np.float32))
+
+    print(f"[build_synonym_store] wrote {len(synonyms)} ingredients / {len(targets)} synonyms → {output_dir}")
+
+if __name__ == "__main__":
+    build_synonym_store(synonyms_path, store_path)
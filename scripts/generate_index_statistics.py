@@ -1,11 +1,43 @@
+import hashlib
 import json
 from pyserini.search.lucene import LuceneSearcher
 from pyserini.index.lucene import LuceneIndexReader
 from tqdm import tqdm
+import numpy as np
 import os
 
 index_path = 'indexes/ingredients_pretokenized'
 stats_path = 'indexes/stats/ingredients_pretokenized.json'
+content_index_path = 'indexes/content'
+content_stats_path = 'indexes/stats/content'
+
+def index_version(index_dir: str) -> str:
+    """
+    Identifies the current commit of a Lucene index: the name of the newest segments_N file
+    plus a hash of its contents (it carries a random id, so a rebuilt index never matches).
+    Used to tell whether precomputed statistics still belong to the index on disk.
+    """
+    segments = [f for f in os.listdir(index_dir) if f.startswith('segments_')]
+    if not segments:
+        return ""
+    latest = max(segments, key=lambda f: int(f[len('segments_'):], 36))
+    with open(os.path.join(index_dir, latest), 'rb') as f:
+        return f"{latest}:{hashlib.sha1(f.read()).hexdigest()}"
+
+# The API workers memory map the files written by the builders. Overwriting one in place truncates it under
+# a worker that has it mapped (SIGBUS), so every file is written to a temporary file next to it and moved over
+# it when complete: a running worker keeps reading the file it opened, a restarted one opens the new one
+def replace_file(path: str, write, mode: str = 'wb'):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as out:
+        write(out)
+    os.replace(tmp_path, path)
+
+def save_array(path: str, array):
+    replace_file(path, lambda out: np.save(out, array))
+
+def save_json(path: str, obj, **kwargs):
+    replace_file(path, lambda out: json.dump(obj, out, **kwargs), 'w')
 
 def generate_index_stats(index_dir: str,
                          output_json_path: str):
@@ -42,11 +74,51 @@ def generate_index_stats(index_dir: str,
     }
     
     os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
-    with open(output_json_path, "w", encoding="utf-8") as out:
-        json.dump(stats, out, ensure_ascii=False, indent=2)
+    save_json(output_json_path, stats, ensure_ascii=False, indent=2)
 
     print(f"[generate_index_stats] wrote stats for {N} docs → {output_json_path}")
     
+def compute_content_stats(index_dir: str):
+    """
+    Document lengths (number of analyzed tokens) and external ids of every document
+    of the content index, in internal docid order.
+    """
+    searcher = LuceneSearcher(index_dir)
+    reader = LuceneIndexReader(index_dir)
+    N = searcher.num_docs
+    dl = np.zeros(N, dtype=np.int32)
+    iids = [None] * N
+    for docid in tqdm(range(N)):
+        doc = searcher.doc(docid)
+        dl[docid] = len(reader.analyze(json.loads(doc.raw())['contents']))
+        iids[docid] = doc.docid()
+    return dl, iids, reader.stats()['total_terms']
+
+def generate_content_stats(index_dir: str,
+                           output_dir: str):
+    """
+    Writes the statistics RecipeSearcher needs for the Dirichlet scoring into `output_dir`:
+      - dl.npy:    int32 document lengths, indexed by internal docid
+      - iids.txt:  external ids, one per line, in internal docid order
+      - meta.json: num_docs, avgdl (the Dirichlet mu), total_terms and the index version
+    """
+    dl, iids, total_terms = compute_content_stats(index_dir)
+    N = len(dl)
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_array(os.path.join(output_dir, 'dl.npy'), dl)
+    replace_file(os.path.join(output_dir, 'iids.txt'), lambda out: out.write('\n'.join(iids)), 'w')
+    save_json(os.path.join(output_dir, 'meta.json'), {
+        "num_docs": N,
+        "avgdl": float(np.sum(dl)) / N if N > 0 else 0.0,
+        "total_terms": total_terms,
+        "index_version": index_version(index_dir)
+    }, indent=2)
+
+    print(f"[generate_content_stats] wrote stats for {N} docs → {output_dir}")
+
 if __name__ == "__main__":
     generate_index_stats(index_path, stats_path)
-    print(f"Index statistics saved to {stats_path}.")
\ No newline at end of file
+    print(f"Index statistics saved to {stats_path}.")
+    generate_content_stats(content_index_path, content_stats_path)
+    print(f"Content index statistics saved to {content_stats_path}.")
\ No newline at end of file
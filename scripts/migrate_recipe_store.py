@@ -0,0 +1,54 @@
+import json
+import os
+import shelve
+import sqlite3
+
+from tqdm import tqdm
+
+shelves_path = 'files/foodrecipes_shelves/foodrecipes_shelves.db'
+store_path = 'files/foodrecipes_store/foodrecipes.sqlite'
+
+# recipes per transaction
+BATCH_SIZE = 10000
+
+def migrate_recipe_store(shelves_db_path: str,
+                         output_path: str,
+                         batch_size: int = BATCH_SIZE):
+    """
+    Copies every recipe of the shelf written by `scripts/index.py` into the SQLite store read by
+    recipe_store.RecipeStore. The store has a single table
+      recipes(id TEXT PRIMARY KEY, data TEXT): data is the recipe dict encoded as JSON
+    It is written to a temporary file first and moved over `output_path` when complete, so a server
+    reading the old store never sees a half written one.
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    # a failed migration leaves the temporary file behind and is simply run again, no journal needed
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('CREATE TABLE recipes (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+    count = 0
+    with shelve.open(shelves_db_path, flag='r') as shelf:
+        batch = []
+        for recipe_id in tqdm(shelf.keys(), desc="Migrating recipes"):
+            batch.append((recipe_id, json.dumps(shelf[recipe_id], ensure_ascii=False, separators=(',', ':'))))
+            if len(batch) >= batch_size:
+                connection.executemany('INSERT INTO recipes VALUES (?, ?)', batch)
+                connection.commit()
+                count += len(batch)
+                batch = []
+        connection.executemany('INSERT INTO recipes VALUES (?, ?)', batch)
+        connection.commit()
+        count += len(batch)
+    connection.execute('ANALYZE')
+    connection.close()
+    os.replace(tmp_path, output_path)
+
+    print(f"[migrate_recipe_store] wrote {count} recipes → {output_path}")
+
+if __name__ == "__main__":
+    migrate_recipe_store(shelves_path, store_path)
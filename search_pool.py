@@ -0,0 +1,142 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class PoolFullError(Exception):
+    """Raised by SearchPool.run when every worker is busy and the queue is full"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Search pool is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+# marks the end of SearchPool.stream
+_END = object()
+
+class SearchPool:
+    """Runs blocking searches off the event loop, on a thread pool with a bounded queue. At most `max_workers`
+    searches run at once and at most `max_queue` wait for a worker; a search arriving when both are taken is
+    rejected straight away (PoolFullError) instead of waiting behind everything else, so latency stays bounded
+    under overload and the server answers other routes (health checks) the whole time. Threads and not
+    processes: the searcher is too big to copy into every process, and its heavy parts (numpy, the JVM,
+    SQLite) release the GIL."""
+
+    def __init__(self, max_workers=4, max_queue=32, retry_after=1, thread_name_prefix='search-request'):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        # seconds a rejected client is told to wait (Retry-After)
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _admit(self):
+        with self._lock:
+            if self._admitted >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolFullError(self.retry_after)
+            self._admitted += 1
+
+    def _call(self, fn, args, kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _done(self, future):
+        with self._lock:
+            self._admitted -= 1
+            self.completed += 1
+
+    def _submit(self, fn, args, kwargs):
+        self._admit()
+        try:
+            future = self._executor.submit(self._call, fn, args, kwargs)
+        except RuntimeError:
+            # shut down
+            with self._lock:
+                self._admitted -= 1
+            raise
+        # released when the search is done, not when the request is: a cancelled request (client gone) keeps
+        # its place until its search actually finishes
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Awaits fn(*args, **kwargs) run on a worker thread. Raises PoolFullError when the queue is full"""
+        return await asyncio.wrap_future(self._submit(fn, args, kwargs))
+
+    def stream(self, fn, *args, buffer=2, **kwargs):
+        """
+        Async iterator over the items of the generator fn(*args, **kwargs), which runs on a worker thread and keeps
+        its place in the pool until it is exhausted or the consumer stops (client gone), so a long stream counts
+        against max_workers like any search. At most `buffer` items wait for the consumer, a slow consumer slows
+        the generator down instead of piling up its items. Must be called on the event loop; raises PoolFullError
+        right away when the queue is full, before anything is sent.
+        """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue(buffer)
+        stopped = threading.Event()
+
+        def put(item):
+            # waits for room in the buffer, giving up once the consumer is gone
+            while not stopped.is_set():
+                try:
+                    asyncio.run_coroutine_threadsafe(asyncio.wait_for(items.put(item), 1), loop).result()
+                    return True
+                except TimeoutError:
+                    continue
+                except RuntimeError:
+                    # the event loop is closed
+                    return False
+            return False
+
+        def produce():
+            try:
+                for item in fn(*args, **kwargs):
+                    if not put((item, None)):
+                        return
+            except Exception as exc:
+                put((_END, exc))
+                return
+            put((_END, None))
+
+        self._submit(produce, (), {})
+
+        async def consume():
+            try:
+                while True:
+                    item, exc = await items.get()
+                    if exc is not None:
+                        raise exc
+                    if item is _END:
+                        return
+                    yield item
+            finally:
+                stopped.set()
+        return consume()
+
+    @property
+    def queue_depth(self):
+        """Searches waiting for a worker"""
+        with self._lock:
+            return self._admitted - self._running
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._running,
+                'queued': self._admitted - self._running,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
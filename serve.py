@@ -0,0 +1,39 @@
+import argparse
+import os
+import secrets
+import subprocess
+import sys
+
+import uvicorn
+
+# Runs the API (main.py) with several worker processes. Every worker starts its own JVM and searcher: a JVM does
+# not survive a fork, so the workers can't inherit a loaded searcher from this process. What they share instead are
+# the memory-mapped index files (doc table, impact index, synonym store, attribute columns, content statistics),
+# which the OS keeps in the page cache once for all of them. This process only makes sure the doc table is built
+# before the workers start. evaluation/measure_worker_memory.py shows what a worker costs with and without it
+
+DOC_TABLE = 'indexes/doc_table'
+# the files scripts/build_doc_table.py reads, the table is rebuilt when one of them is newer
+DOC_TABLE_SOURCES = ['indexes/stats/ingredients_pretokenized.json', 'indexes/stats/content/iids.txt']
+
+def doc_table_outdated():
+    meta_path = os.path.join(DOC_TABLE, 'meta.json')
+    if not os.path.exists(meta_path):
+        return True
+    built = os.path.getmtime(meta_path)
+    return any(os.path.exists(source) and os.path.getmtime(source) > built for source in DOC_TABLE_SOURCES)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the recipe search API with several worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of worker processes")
+    args = parser.parse_args()
+
+    if doc_table_outdated():
+        print(f"Building the doc table in {DOC_TABLE}")
+        # in a separate process, building it starts a JVM and this process starts the workers afterwards
+        subprocess.run([sys.executable, 'scripts/build_doc_table.py'], check=True)
+    # the workers sign their pagination cursors with the same key, so the next page can be asked from any of them
+    os.environ.setdefault('RECIPE_SEARCH_CURSOR_KEY', secrets.token_hex(32))
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)